@@ -0,0 +1,93 @@
+'''
+Microbenchmark for the scanner.
+
+Scans every file in default_user_files and a few large synthetic
+    programs with generate_tokens (Token per match), scan_arrays
+    (compact arrays) and the old 35-way named-group regex.
+
+Usage:
+    python bench_scanner.py [repeats]
+'''
+
+import re
+import sys
+import glob
+import timeit
+from os.path import dirname, join
+
+from parser_utils import generate_tokens, scan_arrays
+
+
+# the old master pattern, keywords are listed before NAME
+_OLD_RULES = [
+    ('NUM', r'\d+(?:\.\d*)?'), ('PLUS', r'\+'), ('MINUS', r'-'),
+    ('TIMES', r'\*'), ('DIVIDE', r'/'), ('DOG', r'@'), ('LPAREN', r'\('),
+    ('RPAREN', r'\)'), ('WS', r'[ \t\r\f\v]+'), ('EQ', r'=='),
+    ('GE', r'>='), ('LE', r'<='), ('NE', r'!='), ('GT', r'>'), ('LT', r'<'),
+    ('ASS', r'[A-Za-z_][A-Za-z_0-9]*[ \t\r\f\v]*=(?!=)'), ('VAR', r'var'),
+    ('DEF', r'def'), ('IF', r'if'), ('ELSE', r'else'), ('FOR', r'for'),
+    ('WHILE', r'while'), ('AND', r'and'), ('OR', r'or'), ('NOT', r'not'),
+    ('RETURN', r'return'), ('NAME', r'[A-Za-z_][A-Za-z_0-9]*'),
+    ('COMMA', r','), ('DOT', r'\.'), ('NL', r'\n'), ('SEMICOLON', r';'),
+    ('LSQBRACK', r'\['), ('RSQBRACK', r'\]'), ('LCUBRACK', r'{'),
+    ('RCUBRACK', r'}'),
+]
+_old_pat = re.compile('|'.join(f'(?P<{n}>{p})' for n, p in _OLD_RULES))
+
+def old_tokens(text):
+    '''tokens from the old master pattern'''
+
+    scanner = _old_pat.scanner(text)
+    return [(m.lastgroup, m.group()) for m in iter(scanner.match, None)
+            if m.lastgroup != 'WS']
+
+
+def synthetic(n):
+    '''program with n functions, loops and diagrams'''
+
+    parts = []
+    for i in range(n):
+        parts.append(f'''
+def fun_{i}(alpha, beta, n) {{
+  if n > 0 and alpha >= beta {{
+    return fun_{i}(beta, alpha + beta * {i}.5, n - 1)
+  }} else {{
+    return [alpha, beta, {i}]
+  }}
+}}
+counter_{i} = 0
+while counter_{i} < 10 {{
+  print(fun_{i}(0, 1, counter_{i}), counter_{i} != {i})
+  counter_{i} = counter_{i} + 1
+}}
+dy_{i} = integ([], [0.0])
+y_{i} = dy_{i} @ integ([], [0.0])
+e_{i} = 1 - (y_{i} + 0.8*dy_{i}); e_{i} @ dy_{i}
+''')
+    return ''.join(parts)
+
+
+def bench(name, text, repeats):
+    '''print scanning speed for text'''
+
+    ntok = len(list(generate_tokens(text)))
+    print(f'{name}: {len(text)} chars, {ntok} tokens')
+    for label, scan in [
+        ('generate_tokens', lambda: list(generate_tokens(text))),
+        ('scan_arrays', lambda: scan_arrays(text)),
+        ('old master_pat', lambda: old_tokens(text)),
+    ]:
+        sec = min(timeit.repeat(scan, number=1, repeat=repeats))
+        print(f'  {label:<16} {sec*1e3:9.3f} ms {ntok/sec/1e6:8.3f} Mtok/s')
+
+
+if __name__ == '__main__':
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    files = sorted(glob.glob(join(dirname(__file__) or '.',
+            'default_user_files', '*.sim')))
+    corpus = '\n'.join(open(f).read() for f in files)
+    bench(f'default_user_files ({len(files)} files)', corpus, repeats)
+
+    for n in [100, 1000, 10000]:
+        bench(f'synthetic({n})', synthetic(n), repeats)
@@ -2,22 +2,28 @@ import json
 import io
 from contextlib import redirect_stdout
 import asyncio
+import threading
 
 from sim_parser import ExpressionEvaluator
+from simulator import Sim
 
 
-async def parse_code(code_str):
+async def parse_code(code_str, cancel):
     loop = asyncio.get_running_loop()
-    parser = ExpressionEvaluator()
+    parser = ExpressionEvaluator(sim=Sim(cancel=cancel))
     out = await loop.run_in_executor(None, parser.parse, code_str)
     return out
 
 async def run_code(code_str, timeout):
     f = io.StringIO()
+    # stops the worker thread on the timeout
+    cancel = threading.Event()
     with redirect_stdout(f):
         try:
-            await asyncio.wait_for(parse_code(code_str), timeout=timeout)
+            await asyncio.wait_for(parse_code(code_str, cancel),
+                    timeout=timeout)
         except asyncio.TimeoutError:
+            cancel.set()
             print(f'Program was running for more than {timeout} '+
                     'sec and was terminated!')
         except Exception as e:
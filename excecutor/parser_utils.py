@@ -1,5 +1,8 @@
 import re
 import collections
+from math import isclose
+from array import array
+from itertools import accumulate
 
 # console plot lib
 #   - pip install termplotlib
@@ -10,95 +13,246 @@ except ImportError:
     print('termplotlib is not found')
 
 try:
-    from .simulator import Block
+    from .simulator import Block, Signal
 except ImportError:
-    from simulator import Block
-
-# tokens
-NUM = r'(?P<NUM>\d+(?:\.\d*)?)'
-PLUS = r'(?P<PLUS>\+)'
-MINUS = r'(?P<MINUS>-)'
-TIMES = r'(?P<TIMES>\*)'
-DIVIDE = r'(?P<DIVIDE>/)'
-DOG = r'(?P<DOG>@)'
-LPAREN = r'(?P<LPAREN>\()'
-RPAREN = r'(?P<RPAREN>\))'
-WS = r'(?P<WS>[ \t\r\f\v]+)'
-EQ = r'(?P<EQ>==)'          # EQ must be above EQUALS
-GE = r'(?P<GE>>=)'          # GE must be above EQUALS and GT
-LE = r'(?P<LE><=)'          # LE must be above EQUALS and LT
-NE = r'(?P<NE>!=)'          # NE must be above EQUALS
-GT = r'(?P<GT>>)'
-LT = r'(?P<LT><)'
-# ASS must be above NAME
-ASS = r'(?P<ASS>[A-Za-z_][A-Za-z_0-9]*[ \t\r\f\v]*=(?!=))'
-VAR = r'(?P<VAR>var)'       # VAR must be above NAME
-DEF = r'(?P<DEF>def)'       # DEF must be above NAME
-IF = r'(?P<IF>if)'          # IF must be above NAME
-ELSE = r'(?P<ELSE>else)'    # ELSE must be above NAME
-FOR = r'(?P<FOR>for)'       # FOR must be above NAME
-WHILE = r'(?P<WHILE>while)' # WHILE must be above NAME
-AND = r'(?P<AND>and)'       # AND must be above NAME
-OR = r'(?P<OR>or)'          # OR must be above NAME
-NOT = r'(?P<NOT>not)'       # NOT must be above NAME
-RETURN = r'(?P<RETURN>return)' # RETURN must be above NAME
-NAME = r'(?P<NAME>[A-Za-z_][A-Za-z_0-9]*)'
-COMMA = r'(?P<COMMA>,)'
-DOT = r'(?P<DOT>\.)'
-NL = r'(?P<NL>\n)'
-SEMICOLON = r'(?P<SEMICOLON>;)'
-LSQBRACK = r'(?P<LSQBRACK>\[)'
-RSQBRACK = r'(?P<RSQBRACK>\])'
-LCUBRACK = r'(?P<LCUBRACK>{)'
-RCUBRACK = r'(?P<RCUBRACK>})'
-
-# master pattern
-master_pat = re.compile('|'.join([
-    NUM,        PLUS,       MINUS,
-    TIMES,      DIVIDE,     DOG,
-    LPAREN,     RPAREN,     WS,
-    EQ,         GE,         LE,
-    NE,         GT,         LT,
-    ASS,        VAR,        DEF,
-    IF,         ELSE,
-    FOR,        WHILE,      AND,
-    OR,
-    NOT,        RETURN,     
-    NAME,       COMMA,      DOT,
-    NL,
-    SEMICOLON,  LSQBRACK,   RSQBRACK,
-    LCUBRACK,   RCUBRACK,   
-]))
-
-# named tuple for tokens
-Token = collections.namedtuple('Token', ['type', 'value'])
+    from simulator import Block, Signal
+
+# token types
+TOKEN_TYPES = (
+    'NUM',      'PLUS',     'MINUS',
+    'TIMES',    'DIVIDE',   'DOG',
+    'LPAREN',   'RPAREN',
+    'EQ',       'GE',       'LE',
+    'NE',       'GT',       'LT',
+    'ASS',      'VAR',      'DEF',
+    'IF',       'ELSE',
+    'FOR',      'WHILE',    'AND',
+    'OR',
+    'NOT',      'RETURN',
+    'NAME',     'COMMA',    'DOT',
+    'NL',
+    'SEMICOLON','LSQBRACK', 'RSQBRACK',
+    'LCUBRACK', 'RCUBRACK',
+)
+
+# type code of each token type (used by scan_arrays)
+TOKEN_CODES = {tp: code for code, tp in enumerate(TOKEN_TYPES)}
+
+# names which are keywords
+KEYWORDS = {
+    'var':      'VAR',
+    'def':      'DEF',
+    'if':       'IF',
+    'else':     'ELSE',
+    'for':      'FOR',
+    'while':    'WHILE',
+    'and':      'AND',
+    'or':       'OR',
+    'not':      'NOT',
+    'return':   'RETURN',
+}
+
+OPERATORS = {
+    '+':    'PLUS',
+    '-':    'MINUS',
+    '*':    'TIMES',
+    '/':    'DIVIDE',
+    '@':    'DOG',
+    '(':    'LPAREN',
+    ')':    'RPAREN',
+    '==':   'EQ',
+    '>=':   'GE',
+    '<=':   'LE',
+    '!=':   'NE',
+    '>':    'GT',
+    '<':    'LT',
+    ',':    'COMMA',
+    '.':    'DOT',
+    ';':    'SEMICOLON',
+    '[':    'LSQBRACK',
+    ']':    'RSQBRACK',
+    '{':    'LCUBRACK',
+    '}':    'RCUBRACK',
+}
+
+# one rule for each class of tokens, keywords and operators
+#   are looked up in the tables above
+#   - spaces before a token are a part of the match (group 1)
+#   - a name followed by "=" (but not "==") is an assignment (ASS)
+#   - two-char operators must be above one-char operators
+#   - any other character is an error (group 7)
+scan_pat = re.compile(r'''([ \t\r\f\v]*)(?:
+    ([A-Za-z_][A-Za-z_0-9]*)([ \t\r\f\v]*=(?!=))?   # 2 NAME, 3 ASS
+  | (\d+(?:\.\d*)?)                                 # 4 NUM
+  | (\n)                                            # 5 NL
+  | (==|>=|<=|!=|[-+*/@()<>,.;\[\]{}])              # 6 operators
+  | (.)                                             # 7 error
+)''', re.VERBOSE)
+
+# named tuple for tokens, line and col start from 1
+Token = collections.namedtuple('Token', ['type', 'value', 'line', 'col'])
+
+# tokens in compact form:
+#   types -- array of token type codes (see TOKEN_CODES)
+#   values -- list of token strings
+#   lines, cols -- arrays of token line and column numbers
+TokenArrays = collections.namedtuple('TokenArrays',
+        ['types', 'values', 'lines', 'cols'])
+
 
 # generate tokens from string
 def generate_tokens(text):
     '''generate tokens from string'''
-    scanner = master_pat.scanner(text)
-    for m in iter(scanner.match, None):
-        tok = Token(m.lastgroup, m.group())
-        # skip spaces
-        if tok.type != 'WS':
-            yield tok
+
+    keywords, operators = KEYWORDS, OPERATORS
+    line, line_start = 1, 0
+    for m in scan_pat.finditer(text):
+        inx = m.lastindex
+        start = m.start(inx)
+        if inx == 2:
+            value = m.group(2)
+            yield Token(keywords.get(value, 'NAME'), value,
+                    line, start - line_start + 1)
+        elif inx == 6:
+            value = m.group(6)
+            yield Token(operators[value], value, line, start - line_start + 1)
+        elif inx == 4:
+            yield Token('NUM', m.group(4), line, start - line_start + 1)
+        elif inx == 5:
+            yield Token('NL', '\n', line, start - line_start + 1)
+            line += 1
+            line_start = start + 1
+        elif inx == 3:
+            # the value is the name without "="
+            start = m.start(2)
+            yield Token('ASS', m.group(2), line, start - line_start + 1)
+        else:
+            raise SyntaxError(f'Unexpected character {m.group(7)!r} ' +
+                    f'at line {line}, col {start - line_start + 1}')
+
+def scan_arrays(text):
+    '''
+    scan the whole text at once into compact arrays (see TokenArrays),
+        all the matching is done by a single findall
+    '''
+
+    codes = TOKEN_CODES
+    name_code, ass_code = codes['NAME'], codes['ASS']
+    num_code, nl_code = codes['NUM'], codes['NL']
+    keywords = {k: codes[v] for k, v in KEYWORDS.items()}
+    operators = {k: codes[v] for k, v in OPERATORS.items()}
+
+    groups = scan_pat.findall(text)
+    try:
+        types = array('B', [
+            (ass_code if ass else keywords.get(name, name_code)) if name
+                else num_code if num
+                else nl_code if nl
+                else operators[op]
+            for _, name, ass, num, nl, op, err in groups
+        ])
+    except KeyError:
+        # an unexpected character, let generate_tokens find it
+        for _ in generate_tokens(text):
+            pass
+        raise
+    values = [name or num or nl or op
+            for _, name, ass, num, nl, op, err in groups]
+    # a token is on the line after all previous NLs
+    lines = array('L', accumulate((tp == nl_code for tp in types), initial=1))
+    lines.pop()
+    # a token starts after the spaces before it
+    cols = array('L')
+    col = 1
+    for spaces, name, ass, num, nl, op, err in groups:
+        col += len(spaces)
+        cols.append(col)
+        col = 1 if nl else col + len(name or num or op) + len(ass)
+    return TokenArrays(types, values, lines, cols)
+
+
+def to_value(obj):
+    '''value of a block or a signal, other objects are returned as is'''
+
+    if isinstance(obj, Block):
+        return obj.outputs[0].val
+    elif isinstance(obj, Signal):
+        return obj.val
+    return obj
+
+def to_series(obj, sim):
+    '''
+    history of a block or a signal, a number is constant on the steps
+        of the last run
+    '''
+
+    if isinstance(obj, Block):
+        obj = obj.outputs[0]
+    if isinstance(obj, Signal):
+        # views of the histories, they are not copied
+        return obj.hist.view()
+    return array('d', [obj])*len(sim.t_hist)
 
 
 # system functions
 def plot(pars, memo_space, sim):
     # todo use names in pars instead of signals
     '''plot function'''
-    x_block, y_block = pars
-    x = x_block.outputs[0].hist
-    y = y_block.outputs[0].hist
+    x, y = (to_series(obj, sim) for obj in pars)
     fig = tpl.figure()
     fig.plot(x, y, height=15)
     fig.show()
     return None
 
 def calc(pars, memo_space, sim):
-    dt, tmax = map(lambda b: b.pars[0], pars)
-    sim.calc(dt, tmax)
+    '''calc(dt, tmax, {method}, {rtol}, {atol})'''
+    dt, tmax, *method = map(to_value, pars)
+    # the variables passed to plot and probe are recorded
+    if sim.probe_names:
+        sim.probe(*(memo_space[name] for name in sim.probe_names
+                if name in memo_space))
+    every, envelope = sim.recording
+    steady, window = sim.settling
+    sim.calc(dt, tmax, *method, every=every, envelope=envelope,
+            steady=steady, window=window)
+    return None
+
+def record(pars, memo_space, sim):
+    '''
+    record(every, {envelope}) the next calcs record the histories every
+        that time, envelope -- record the min and max between them
+    '''
+    every, *envelope = map(to_value, pars)
+    sim.recording = (every or None, bool(envelope and envelope[0]))
+    return None
+
+def steady(pars, memo_space, sim):
+    '''
+    steady(tol, {window}) the next calcs stop once the integs and
+        the probed signals which depend on them change by at most tol
+        per time unit for window time, tol 0 turns it off
+    '''
+    tol, *window = map(to_value, pars)
+    sim.settling = (tol or None, window[0] if window else None)
+    return None
+
+def probe(pars, memo_space, sim):
+    '''
+    probe(signals...) records the histories of the signals only,
+        unless the names to plot are not known from the code
+    '''
+    if sim.probe_names is not None:
+        sim.probe(*pars)
+    return None
+
+def stats(pars, memo_space, sim):
+    '''print the steps of the last calc'''
+    if sim.stats:
+        print(f'accepted: {sim.stats.accepted}, ' +
+                f'rejected: {sim.stats.rejected}, evals: {sim.stats.evals}, ' +
+                f'events: {sim.stats.events}')
+    if sim.t_steady is not None:
+        print(f'steady: {round(sim.t_steady, 5)}')
     return None
 
 def array_to_str(arr):
@@ -116,7 +270,9 @@ def array_to_str(arr):
 def print_signal(pars, memo_space, sim):
     lines = []
     for par in pars:
-        if isinstance(par, Block):
+        if isinstance(par, float):
+            lines.append(str(round(par, 5)))
+        elif isinstance(par, Block):
             # lines.append(f'{par.block_type}_{par.id} = {round(par.outputs[0].val, 5)}')
             lines.append(str(round(par.outputs[0].val, 5)))
             # lines.append(str(par.outputs[0].val))
@@ -131,14 +287,23 @@ def debug(pars, memo_space, sim):
     print(sim)
     
 
-sys_funs = {'plot': plot, 'calc': calc, 'print': print_signal, 'debug': debug}
+sys_funs = {'plot': plot, 'calc': calc, 'print': print_signal, 'debug': debug,
+        'stats': stats, 'probe': probe, 'record': record, 'steady': steady}
+
+def equal(x, y):
+    '''numbers are equal if they are close'''
+
+    if isinstance(x, float) or isinstance(y, float):
+        return isclose(x, y)
+    return x == y
 
+# comparison of values (see to_value)
 logic_funs = {
     '>':    lambda x, y: x > y,
     '<':    lambda x, y: x < y,
-    '>=':   lambda x, y: x >= y,
-    '<=':   lambda x, y: x <= y,
-    '==':   lambda x, y: x == y,
-    '!=':   lambda x, y: x != y,
+    '>=':   lambda x, y: x > y or equal(x, y),
+    '<=':   lambda x, y: x < y or equal(x, y),
+    '==':   equal,
+    '!=':   lambda x, y: not equal(x, y),
     'not':  lambda x: not x,
 }
\ No newline at end of file
@@ -0,0 +1,543 @@
+'''
+Abstract syntax tree for the interpretator.
+
+The source is turned into a tree only once, after that the tree
+    is evaluated as many times as needed (function calls, loops),
+    so tokens are never scanned twice.
+Function bodies are kept as slices of the token list (Body) and
+    are parsed on the first call.
+'''
+
+from collections import namedtuple
+
+try:
+    # works for django
+    from .parser_utils import generate_tokens, logic_funs
+    from .simulator import BLOCK_TYPES
+except ImportError:
+    # works outside of django
+    from parser_utils import generate_tokens, logic_funs
+    from simulator import BLOCK_TYPES
+
+
+# statements
+Code = namedtuple('Code', ['stmts'])                    # stmt; stmt; ...
+Def = namedtuple('Def', ['name', 'pars', 'body'])       # def name(pars) {Body}
+Return = namedtuple('Return', ['expr'])                 # return expr
+If = namedtuple('If', ['branches', 'orelse'])           # [(cond, body), ...]
+While = namedtuple('While', ['cond', 'body'])           # while cond {body}
+Assig = namedtuple('Assig', ['name', 'expr'])           # name = expr
+
+# expressions
+BinOp = namedtuple('BinOp', ['op', 'left', 'right'])    # + - * / @
+Logic = namedtuple('Logic', ['op', 'left', 'right'])    # and, or
+Compare = namedtuple('Compare', ['op', 'left', 'right'])# > < == >= <= !=
+Not = namedtuple('Not', ['expr'])                       # not expr
+Neg = namedtuple('Neg', ['expr'])                       # -expr
+Num = namedtuple('Num', ['value'])                      # 42
+Const = namedtuple('Const', ['value'])                  # folded boolean
+Array = namedtuple('Array', ['items'])                  # [a, b, ...]
+Name = namedtuple('Name', ['name'])                     # var
+Index = namedtuple('Index', ['target', 'index'])        # var[index]
+Port = namedtuple('Port', ['target', 'attr'])           # var.in, var.out
+Call = namedtuple('Call', ['target', 'args'])           # var(args)
+Create = namedtuple('Create', ['block_type', 'args'])   # integ(pars, states)
+
+
+# arithmetic which can be done at compile time
+FOLD_OPS = {
+    'PLUS':     lambda x, y: x + y,
+    'MINUS':    lambda x, y: x - y,
+    'TIMES':    lambda x, y: x * y,
+    'DIVIDE':   lambda x, y: x / y,
+}
+
+
+def fold(node):
+    '''
+    constant folding, evaluates constant sub-expressions
+        e.g. BinOp(TIMES, Num(2), Num(2)) -> Num(4)
+    function bodies are folded when they are compiled
+    '''
+
+    tp = type(node)
+    if tp is Code:
+        return Code([fold(stmt) for stmt in node.stmts])
+    elif tp is Assig:
+        return Assig(node.name, fold(node.expr))
+    elif tp is Return:
+        return Return(fold(node.expr))
+    elif tp is If:
+        return If([(fold(c), fold(b)) for c, b in node.branches],
+                node.orelse and fold(node.orelse))
+    elif tp is While:
+        return While(fold(node.cond), fold(node.body))
+    elif tp is BinOp:
+        left, right = fold(node.left), fold(node.right)
+        if type(left) is Num and type(right) is Num and node.op in FOLD_OPS:
+            try:
+                return Num(FOLD_OPS[node.op](left.value, right.value))
+            except ZeroDivisionError:
+                pass # will be raised in run time
+        return BinOp(node.op, left, right)
+    elif tp is Neg:
+        expr = fold(node.expr)
+        return Num(-expr.value) if type(expr) is Num else Neg(expr)
+    elif tp is Compare:
+        left, right = fold(node.left), fold(node.right)
+        if type(left) is Num and type(right) is Num:
+            return Const(logic_funs[node.op](left.value, right.value))
+        return Compare(node.op, left, right)
+    elif tp is Not:
+        expr = fold(node.expr)
+        return Const(not expr.value) if type(expr) is Const else Not(expr)
+    elif tp is Logic:
+        left, right = fold(node.left), fold(node.right)
+        if type(left) is Const and type(right) is Const:
+            if node.op == 'or':
+                return Const(left.value | right.value)
+            return Const(left.value & right.value)
+        return Logic(node.op, left, right)
+    elif tp is Array:
+        return Array([fold(item) for item in node.items])
+    elif tp is Index:
+        return Index(fold(node.target), fold(node.index))
+    elif tp is Port:
+        return Port(fold(node.target), node.attr)
+    elif tp is Call:
+        return Call(fold(node.target), [fold(arg) for arg in node.args])
+    elif tp is Create:
+        return Create(node.block_type, [fold(arg) for arg in node.args])
+    return node
+
+
+# calls which need the histories of their arguments
+PROBE_CALLS = {'plot', 'probe'}
+
+def probe_names(node):
+    '''
+    names of the variables passed to plot and probe, their signals
+        are recorded on calc (see Sim.probe), None if the names can
+        not be known from the code, then all the signals are
+        recorded: a plot or probe in a function body (bodies are
+        not parsed yet) or not called by its name, an argument
+        which is not a name or a name assigned after a calc
+    '''
+
+    names = set()
+    # names assigned after a calc
+    assigned = set()
+    calcs = False
+    todo = [node]
+    while todo:
+        node = todo.pop()
+        tp = type(node)
+        if tp is Body:
+            if any(_calls(node, name) for name in PROBE_CALLS):
+                return None
+            # the function can be called after any statement
+            calcs = calcs or _calls(node, 'calc')
+            continue
+        if tp is Name:
+            if node.name in PROBE_CALLS:
+                return None
+            continue
+        if tp is Call and type(node.target) is Name:
+            if node.target.name in PROBE_CALLS:
+                if any(type(arg) is not Name for arg in node.args):
+                    return None
+                names.update(arg.name for arg in node.args)
+                continue
+            calcs = calcs or node.target.name == 'calc'
+        elif tp is Assig and calcs:
+            assigned.add(node.name)
+        elif tp is While and not calcs:
+            # the statements of a loop with a calc go after it
+            calcs = _calls(node, 'calc')
+        if isinstance(node, (tuple, list)):
+            # the children are taken in the order of the code
+            todo.extend(reversed(node))
+    if names & assigned:
+        return None
+    return names
+
+def _calls(node, name):
+    '''true if the tree calls the name, function bodies included'''
+
+    todo = [node]
+    while todo:
+        node = todo.pop()
+        if type(node) is Body:
+            if any(tok.type == 'NAME' and tok.value == name
+                    for tok in node.tokens[node.start:node.end]):
+                return True
+        elif type(node) is Call and type(node.target) is Name and \
+                node.target.name == name:
+            return True
+        elif isinstance(node, (tuple, list)):
+            todo.extend(node)
+    return False
+
+
+def match_brackets(tokens, start, end):
+    '''find matching curly brackets, returns {'{' index: '}' index}'''
+
+    match = {}
+    opened = []
+    for inx in range(start, end):
+        tp = tokens[inx].type
+        if tp == 'LCUBRACK':
+            opened.append(inx)
+        elif tp == 'RCUBRACK':
+            if not opened:
+                raise SyntaxError(f'Unexpected {tokens[inx]}')
+            match[opened.pop()] = inx
+    if opened:
+        raise SyntaxError(f'Expected RCUBRACK for {tokens[opened[-1]]}')
+    return match
+
+
+class Body:
+    '''
+    body of a function, tokens[start:end] without copying,
+        the body is parsed only when its tree is needed
+    '''
+
+    def __init__(self, tokens, brackets, start, end):
+        '''
+        tokens -- the whole list of tokens
+        brackets -- matching curly brackets, see match_brackets
+        start, end -- slice of tokens inside the curly brackets
+        '''
+
+        self.tokens = tokens
+        self.brackets = brackets
+        self.start = start
+        self.end = end
+        self._tree = None
+
+    @property
+    def tree(self):
+        '''AST of the body, ast.Code'''
+
+        if self._tree is None:
+            self._tree = Parser().parse(self.tokens, self.start, self.end,
+                    self.brackets)
+        return self._tree
+
+    def __repr__(self):
+        return f'Body(start={self.start}, end={self.end})'
+
+
+class Parser:
+    '''Recursive descent parser, builds AST from tokens'''
+
+    def parse(self, inp, start=0, end=None, brackets=None):
+        '''
+        parse a string or a list of tokens into AST,
+            only tokens[start:end] are parsed
+        brackets -- matching curly brackets if they are already known
+        '''
+
+        # inp is either a list or a string
+        # generate tokens or use inp as tokens
+        if isinstance(inp, list):
+            self.tokens = inp
+        elif isinstance(inp, str):
+            self.tokens = list(generate_tokens(inp))
+        else:
+            raise SyntaxError('inp must be a list of Tokens or a string')
+
+        self.pos = start
+        self.end = len(self.tokens) if end is None else end
+        self.brackets = brackets if brackets is not None \
+                else match_brackets(self.tokens, self.pos, self.end)
+        self.tok = None
+
+        tree = self.code()
+        if self.nexttok:
+            raise SyntaxError(f'Unexpected {self.nexttok}')
+        return tree
+
+    @property
+    def nexttok(self):
+        '''token after the current one'''
+
+        return self.tokens[self.pos] if self.pos < self.end else None
+
+    def _advance(self):
+        '''move by one token'''
+
+        self.tok = self.tokens[self.pos]
+        self.pos += 1
+
+    def _accept(self, toktype):
+        '''try to _advance if nexttoken is toketype'''
+
+        if self.pos < self.end and self.tokens[self.pos].type == toktype:
+            self._advance()
+            return True
+        else:
+            return False
+
+    def _expect(self, toktype):
+        '''_expect this toktype to occure next, else raise an exeption'''
+
+        if not self._accept(toktype):
+            raise SyntaxError(f'Expected {toktype}, got {self.nexttok}')
+
+    def _skip_sep(self):
+        '''skip ';' and '\\n' '''
+
+        while self._accept('NL') or self._accept('SEMICOLON'):
+            pass
+
+    def _accept_after_sep(self, toktype):
+        '''
+        accept toktype even if it is placed after separators,
+            separators are not skipped if there is no toktype
+        '''
+
+        pos = self.pos
+        self._skip_sep()
+        if self._accept(toktype):
+            return True
+        self.pos = pos
+        return False
+
+    def _block(self):
+        '''
+        "{" code "}"
+        '''
+
+        self._skip_sep()
+        self._expect('LCUBRACK')
+        body = self.code()
+        self._expect('RCUBRACK')
+        return body
+
+    def _exprs(self, closing):
+        '''
+        { log_expr "," }* closing
+        '''
+
+        items = []
+        while not self._accept(closing):
+            items.append(self.log_expr())
+            if not self._accept('COMMA'):
+                self._expect(closing)
+                break
+        return items
+
+    # ----------------SYNTAX---------------------------
+    def code(self):
+        '''
+        code    ::=  assig { ('\\n'|';') assig }*
+        '''
+
+        stmts = []
+        self._skip_sep()
+        while self.nexttok and self.nexttok.type != 'RCUBRACK':
+            stmts.append(self.assig())
+            # blocks like if {...} can be followed by a statement
+            #   without a separator
+            if not (self._accept('NL') or self._accept('SEMICOLON')) \
+                    and self.tok.type != 'RCUBRACK':
+                break
+            self._skip_sep()
+        return Code(stmts)
+
+    def fun(self):
+        '''
+        "def" NAME "(" { pars } ")" "{" code "}"
+        '''
+
+        self._expect('NAME')
+        name = self.tok.value
+        self._expect('LPAREN')
+        pars = self.pars()
+        self._expect('RPAREN')
+        self._skip_sep()
+        self._expect('LCUBRACK')
+        # skip the body, it will be parsed on the first call
+        end = self.brackets[self.pos - 1]
+        body = Body(self.tokens, self.brackets, self.pos, end)
+        self.pos = end
+        self._advance()
+        return Def(name, pars, body)
+
+    def assig(self):
+        '''
+        assig   ::= "def" fun
+                        | "return" expr
+                        | "if" if_exp
+                        | "for" for_exp         # not implemented
+                        | "while" while_exp
+                        | ASS { log_expr }
+        '''
+
+        if self._accept('DEF'): # define function
+            return self.fun()
+        elif self._accept('RETURN'):
+            # return from function,
+            #   works like break inside a while loop
+            return Return(self.expr())
+        elif self._accept('IF'): # if-statement
+            return self.if_exp()
+        elif self._accept('FOR'): # for-loop in development
+            return self.for_exp()
+        elif self._accept('WHILE'): # while-loop
+            return self.while_exp()
+
+        if self._accept('ASS'): # assign, e.g. var = ...
+            name = self.tok.value
+        else:
+            name = '_'
+
+        return Assig(name, self.log_expr())
+
+    def pars(self):
+        '''
+        pars ::= { NAME {','} }*
+        '''
+
+        pars = []
+        while self._accept('NAME'):
+            pars.append(self.tok.value)
+            self._accept('COMMA')
+        return pars
+
+    def expr(self):
+        '''
+        expr ::= term { ('+'|'-') term }*
+        '''
+
+        node = self.term()
+        while self._accept('PLUS') or self._accept('MINUS'):
+            node = BinOp(self.tok.type, node, self.term())
+        return node
+
+    def term(self):
+        '''
+        term ::= factor { ('*'|'/'|'@') factor }*
+        '''
+
+        node = self.factor()
+        while self._accept('TIMES') or self._accept('DIVIDE') \
+                or self._accept('DOG'):
+            node = BinOp(self.tok.type, node, self.factor())
+        return node
+
+    def factor(self):
+        '''
+        factor      ::=  {+} {-} ( NUM | "(" log_expr ")" | '[' {log_expr}* ']' | named )
+        '''
+
+        self._accept('PLUS')
+        minus = self._accept('MINUS')
+        if self._accept('NUM'):
+            return Num((-1 if minus else 1) * float(self.tok.value))
+        elif self._accept('LPAREN'):
+            node = self.log_expr()
+            self._expect('RPAREN')
+        elif self._accept('LSQBRACK'):
+            node = Array(self._exprs('RSQBRACK'))
+        elif self._accept('NAME'):
+            node = self.named()
+        else:
+            raise SyntaxError('expected a number, an open parentheses,'+
+                    f'\n\ta variable, or a function, got {self.nexttok}')
+        return Neg(node) if minus else node
+
+    def named(self):
+        '''
+        named       ::=  NAME {"[" log_expr "]"} {"(" {log_expr ","}* ")"} {".in" | ".out"}
+        '''
+
+        name = self.tok.value
+        node = Name(name)
+        while True:
+            if self._accept('DOT'):
+                self._expect('NAME')
+                par = self.tok.value
+                # dot syntax can be used only with .in and .out right now
+                if par not in ['in', 'out']:
+                    raise SyntaxError('Dot syntax can be used only with .in and .out')
+                node = Port(node, par + 'puts')
+            elif self._accept('LSQBRACK'):
+                index = self.log_expr()
+                self._expect('RSQBRACK')
+                node = Index(node, index)
+            elif self._accept('LPAREN'):
+                args = self._exprs('RPAREN')
+                if node == Name(name) and name in BLOCK_TYPES:
+                    if len(args) != 2:
+                        raise SyntaxError(f'Block {name} expected 2 parameters, ' +
+                                f'but got {len(args)}')
+                    return Create(name, args)
+                return Call(node, args)
+            else:
+                return node
+
+    def cond(self):
+        '''
+        cond    ::=  {"not"} expr { (">"|"<"|"=="|">="|"<="|"!=") expr }
+        '''
+
+        is_not = self._accept('NOT')
+        node = self.expr()
+        if self._accept('GT') or self._accept('LT') or self._accept('EQ') \
+            or self._accept('GE') or self._accept('LE') or self._accept('NE'):
+            node = Compare(self.tok.value, node, self.expr())
+        return Not(node) if is_not else node
+
+    def if_exp(self):
+        '''
+        if_exp      ::=  "if" log_expr "{" code "}"
+                           { "else" if_exp }*
+                           {"else" "{" code "}"}
+        '''
+
+        branches = [(self.log_expr(), self._block())]
+        orelse = None
+        while self._accept_after_sep('ELSE'):
+            self._skip_sep()
+            if self._accept('IF'):
+                branches.append((self.log_expr(), self._block()))
+            else:
+                orelse = self._block()
+                break
+        return If(branches, orelse)
+
+    def log_expr(self):
+        '''
+        log_expr::=  log_term { "or" log_term }*
+        '''
+
+        node = self.log_term()
+        while self._accept('OR'):
+            node = Logic('or', node, self.log_term())
+        return node
+
+    def log_term(self):
+        '''
+        log_term::=  cond { "and" cond }*
+        '''
+
+        node = self.cond()
+        while self._accept('AND'):
+            node = Logic('and', node, self.cond())
+        return node
+
+    def while_exp(self):
+        '''
+        while_exp   ::=  "while" log_expr "{" code "}"
+        '''
+
+        return While(self.log_expr(), self._block())
+
+    def for_exp(self):
+        '''
+        for-exp ::=  "for" named "=" "NUM":{"NUM":}"NUM" "{" code "}"
+        '''
+        raise NotImplementedError('For-loop is not yet implemented')
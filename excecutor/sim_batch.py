@@ -0,0 +1,318 @@
+'''
+Batched simulation for large diagrams.
+
+All the signal values live in one float64 array and the blocks keep
+    indexes into it. Blocks are sorted into levels, the blocks of one
+    level do not depend on each other, so the blocks of the same type
+    on a level are calculated by one numpy operation.
+A block is put on a higher level than every block it must follow in
+    the schedule (see Sim.schedule): the blocks calculating its inputs
+    and the blocks which read its outputs before it (an integ reading
+    a signal calculated later gets the value from the previous step),
+    so the results are the same as the block by block run.
+Blocks with sample periods (see sample_periods in simulator) are
+    batched with the blocks of the same period and skip the other
+    steps, discrete states are updated after all the levels.
+'''
+
+import numpy as np
+
+try:
+    # works for django
+    from .sim_codegen import graph_shape, KERNELS, UPDATES
+    from .sim_history import Decimator
+    from .sim_errors import SimCancelled
+except ImportError:
+    # works outside of django
+    from sim_codegen import graph_shape, KERNELS, UPDATES
+    from sim_history import Decimator
+    from sim_errors import SimCancelled
+
+
+# use batches for schedules with at least as many blocks per batch
+BATCH_WIDTH = 16
+
+
+def levels(shape):
+    '''level of each block of the graph shape (see graph_shape)'''
+
+    producers = {}
+    for k, (_, _, _, outps, _) in enumerate(shape):
+        for n in outps:
+            producers[n] = k
+
+    level = []
+    readers = {}
+    for k, (_, _, inps, outps, _) in enumerate(shape):
+        lvl = 0
+        for n in inps:
+            p = producers.get(n)
+            if p is not None and p < k:
+                lvl = max(lvl, level[p] + 1)
+            readers.setdefault(n, []).append(k)
+        for n in outps:
+            for r in readers.get(n, ()):
+                if r != k:
+                    lvl = max(lvl, level[r] + 1)
+        level.append(lvl)
+    return level
+
+def batches(shape, periods=None):
+    '''
+    batches of the blocks by levels, each batch is
+        (block_type, source, period, block numbers), block_type is
+        None for the blocks called one by one
+    '''
+
+    periods = periods or [1]*len(shape)
+    groups = {}
+    for k, (lvl, (block_type, source, _, outps, nstates)) in enumerate(
+            zip(levels(shape), shape)):
+        if (block_type, source) not in KERNELS or len(outps) != 1 or (
+                block_type == 'integ' and nstates != 1):
+            key = (lvl, None, None, periods[k])
+        else:
+            key = (lvl, block_type, source, periods[k])
+        groups.setdefault(key, []).append(k)
+    return [(block_type, source, period, ks)
+            for (_, block_type, source, period), ks in sorted(
+                    groups.items(), key=lambda item: item[0][0])]
+
+def use_batches(order, periods=None):
+    '''true if the schedule is wide enough for batches'''
+
+    if len(order) < BATCH_WIDTH:
+        return False
+    return len(order) >= BATCH_WIDTH * len(
+            batches(graph_shape(order)[0], periods))
+
+
+def compile_batches(order, periods=None, every=1, envelope=False):
+    '''
+    run function for the schedule, the blocks of a level are calculated
+        at once, the arguments and the run are as for
+        sim_codegen.compile_run
+    '''
+
+    shape, signals = graph_shape(order)
+    vals = np.array([sig._val for sig in signals], dtype=np.float64)
+    # outputs of the blocks, the recorded ones get the history
+    #   from the array
+    outputs = [n for _, _, _, outps, _ in shape for n in outps]
+    recorded = np.array([n for n in outputs if signals[n].recorded],
+            dtype=np.intp)
+    # outputs checked for the steady state
+    monitored = np.array([n for n in outputs if signals[n].monitored],
+            dtype=np.intp)
+    # blocks with states and their states arrays
+    stateful = []
+    kernels = []
+    # discrete state updates after all the kernels
+    updates = []
+
+    def index(ks, port, inx=0):
+        '''array of signal numbers for a port of blocks'''
+
+        return np.array([shape[k][port][inx] for k in ks], dtype=np.intp)
+
+    for block_type, source, period, ks in batches(shape, periods):
+        if block_type is None:
+            kernels += [_call_kernel(vals, signals, order[k], shape[k],
+                    period) for k in ks]
+            updates += [_call_update(order[k], period) for k in ks
+                    if order[k].block_type in UPDATES]
+            continue
+        start = len(kernels)
+        o = index(ks, 3)
+        a = index(ks, 2) if shape[ks[0]][2] else None
+        b = index(ks, 2, 1) if len(shape[ks[0]][2]) > 1 else None
+        if block_type == 'num':
+            pars = np.array([order[k].pars[0] for k in ks], dtype=np.float64)
+            kernels.append(_num_kernel(vals, o, pars, None if source else a))
+        elif block_type == 'integ':
+            states = np.array([order[k].states[0] for k in ks],
+                    dtype=np.float64)
+            stateful.append(([order[k] for k in ks], states))
+            kernels.append(_integ_kernel(vals, o, a, states))
+        elif block_type in ('delay', 'dinteg'):
+            states = np.array([order[k].states[0] for k in ks],
+                    dtype=np.float64)
+            stateful.append(([order[k] for k in ks], states))
+            kernels.append(_state_kernel(vals, o, states))
+            updates.append(_period_kernel(_UPDATE_KERNELS[block_type](
+                    vals, a, states, period), period))
+        elif block_type == 'time':
+            kernels.append(_time_kernel(vals, o))
+        elif block_type in ('disp', 'zoh'):
+            kernels.append(_disp_kernel(vals, o, a))
+        elif block_type == 'div':
+            kernels.append(_div_kernel(vals, o, a, b))
+        else:
+            kernels.append(_binary_kernel(vals, o, a, b,
+                    BINARY_UFUNCS[block_type]))
+        if period > 1:
+            kernels[start:] = [_period_kernel(kernel, period)
+                    for kernel in kernels[start:]]
+
+    def run(dt, tmax, t_hist, tick=None, check=0, t=0, step=0, steady=None):
+        '''simulate from t to tmax with step dt'''
+
+        decimator = Decimator([signals[n].hist for n in recorded.tolist()],
+                t_hist, every, envelope, start=step)
+        # float overflows and nans are not errors as for python floats
+        with np.errstate(all='ignore'):
+            while t <= tmax:
+                if tick is not None and not step % check:
+                    tick(t)
+                for kernel in kernels:
+                    kernel(step, t, dt)
+                for kernel in updates:
+                    kernel(step, t, dt)
+                if decimator.record(t, vals[recorded]):
+                    yield
+                if steady is not None and steady.check(t,
+                        vals[monitored].tolist()):
+                    t += dt
+                    step += 1
+                    break
+                t += dt
+                step += 1
+        decimator.flush()
+
+        # move the values into the signals and blocks
+        for n in outputs:
+            signals[n]._val = vals.item(n)
+        for blocks, states in stateful:
+            for block, state in zip(blocks, states.tolist()):
+                block.states[0] = state
+        return step, t
+
+    return run
+
+
+BINARY_UFUNCS = {
+    'add':  np.add,
+    'sub':  np.subtract,
+    'mult': np.multiply,
+}
+
+def _num_kernel(vals, o, pars, a):
+    '''num sources (a is None) or gains'''
+
+    if a is None:
+        def kernel(step, t, dt):
+            vals[o] = pars
+    else:
+        def kernel(step, t, dt):
+            vals[o] = pars * vals[a]
+    return kernel
+
+def _binary_kernel(vals, o, a, b, ufunc):
+    '''add, sub and mult blocks'''
+
+    def kernel(step, t, dt):
+        vals[o] = ufunc(vals[a], vals[b])
+    return kernel
+
+def _div_kernel(vals, o, a, b):
+    '''div blocks, division by zero keeps the output as it is'''
+
+    def kernel(step, t, dt):
+        den = vals[b]
+        zero = den == 0
+        if zero.any():
+            res = np.where(zero, vals[o], vals[a] / np.where(zero, 1, den))
+            for _ in range(int(zero.sum())):
+                print('float division by zero')
+            vals[o] = res
+        else:
+            vals[o] = vals[a] / den
+    return kernel
+
+def _period_kernel(kernel, period):
+    '''the kernel on the steps of the period only'''
+
+    def period_kernel(step, t, dt):
+        if not step % period:
+            kernel(step, t, dt)
+    return period_kernel
+
+def _state_kernel(vals, o, states):
+    '''outputs of delays and discrete integrators'''
+
+    def kernel(step, t, dt):
+        vals[o] = states
+    return kernel
+
+def _delay_update(vals, a, states, period):
+    '''delays keep the inputs'''
+
+    def kernel(step, t, dt):
+        u = vals[a]
+        states[:] = np.where(u == u, u, states)
+    return kernel
+
+def _dinteg_update(vals, a, states, period):
+    '''discrete integrators integrate the inputs over the sample'''
+
+    def kernel(step, t, dt):
+        u = vals[a]
+        states[:] = np.where(u == u, states + period*dt*u, states)
+    return kernel
+
+_UPDATE_KERNELS = {
+    'delay':    _delay_update,
+    'dinteg':   _dinteg_update,
+}
+
+def _integ_kernel(vals, o, a, states):
+    '''integs, states are integrated with rect_meth'''
+
+    def kernel(step, t, dt):
+        u = vals[a]
+        states[:] = states + dt*np.where(u == u, u, states)
+        vals[o] = states
+    return kernel
+
+def _time_kernel(vals, o):
+    '''time blocks'''
+
+    def kernel(step, t, dt):
+        vals[o] = t
+    return kernel
+
+def _disp_kernel(vals, o, a):
+    '''disp blocks'''
+
+    def kernel(step, t, dt):
+        vals[o] = vals[a]
+    return kernel
+
+def _call_kernel(vals, signals, block, block_shape, period=1):
+    '''a block calculated by Block.update'''
+
+    _, _, inps, outps, _ = block_shape
+
+    def kernel(step, t, dt):
+        if step % period:
+            # the outputs hold
+            return
+        for n in inps:
+            signals[n]._val = vals.item(n)
+        try:
+            block.update(t, dt)
+        except SimCancelled:
+            raise
+        except Exception as ex:
+            print(ex)
+        for n in outps:
+            vals[n] = signals[n]._val
+    return kernel
+
+def _call_update(block, period):
+    '''a discrete block updated by Block.update_states'''
+
+    def kernel(step, t, dt):
+        if not step % period:
+            block.update_states(t, period*dt)
+    return kernel
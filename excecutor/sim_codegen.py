@@ -0,0 +1,339 @@
+'''
+Code generation for the simulation loop.
+
+compile_run turns a block schedule (see Sim.schedule) into a Python
+    function running the whole simulation. The blocks' functions
+    (num, add, sub, mult, div, integ, time, disp) are inlined into
+    the step as arithmetic on local variables, other blocks (fun)
+    are called through Block.update.
+The generated code does the same float operations in the same order
+    as Block.update, so the results and histories are the same.
+Blocks with sample periods (see sample_periods in simulator) are
+    calculated only on their steps, their outputs hold in between.
+The histories are written by index into their arrays preallocated
+    by Sim.calc (see sim_history), num sources get constant ones,
+    only every some steps are written if asked, envelopes are
+    recorded by a sim_history.Decimator.
+The run stops early once the monitored signals are steady (see
+    sim_history.Steady) if asked.
+Functions are cached by graph shape (block types and wiring) and
+    periods, pars and states are read from the blocks on each run.
+
+compile_deriv makes the derivative function of the integ states for
+    the solvers in sim_solvers in the same way.
+'''
+
+from functools import lru_cache
+
+try:
+    # works for django
+    from .sim_history import Decimator
+    from .sim_errors import SimCancelled
+except ImportError:
+    # works outside of django
+    from sim_history import Decimator
+    from sim_errors import SimCancelled
+
+
+def graph_shape(order):
+    '''
+    shape of the scheduled graph and its signals,
+        shape -- tuple of (block_type, source, inputs, outputs, states
+            number) for each block, inputs and outputs are numbers
+            of signals
+        signals -- list of all the signals by their numbers
+    '''
+
+    numbers = {}
+    signals = []
+
+    def number(sig):
+        '''number of the signal, new signals get the next one'''
+
+        key = id(sig)
+        if key not in numbers:
+            numbers[key] = len(signals)
+            signals.append(sig)
+        return numbers[key]
+
+    shape = tuple(
+        (block.block_type, block.source,
+         tuple(number(inp) for inp in block.inputs),
+         tuple(number(outp) for outp in block.outputs),
+         len(block.states))
+        for block in order
+    )
+    return shape, signals
+
+
+# code for the inlined blocks, {o} -- output, {a}, {b} -- inputs,
+#   {p} -- pars[0], {x} -- states[0]
+KERNELS = {
+    ('num', True):      ['{o} = {p}'],
+    ('num', False):     ['{o} = {p} * {a}'],
+    ('add', False):     ['{o} = {a} + {b}'],
+    ('sub', False):     ['{o} = {a} - {b}'],
+    ('mult', False):    ['{o} = {a} * {b}'],
+    ('div', False):     ['{o} = {a} / {b}'],
+    ('disp', False):    ['{o} = {a}'],
+    ('time', True):     ['{o} = t'],
+    # states are integrated with rect_meth, nan input means no input
+    ('integ', True):    ['{x} = {x} + dt*({a} if {a} == {a} else {x})',
+                         '{o} = {x}'],
+    ('delay', True):    ['{o} = {x}'],
+    ('zoh', False):     ['{o} = {a}'],
+    ('dinteg', True):   ['{o} = {x}'],
+}
+
+# state updates of the discrete blocks after all the blocks of the
+#   step, {T} -- the sample time
+UPDATES = {
+    'delay':    ['{x} = {a} if {a} == {a} else {x}'],
+    'dinteg':   ['{x} = {x} + {T}*{a} if {a} == {a} else {x}'],
+}
+
+# blocks which can raise on float arguments
+GUARDED = {'div'}
+
+
+def _indent(lines):
+    '''lines as a block of an if or try'''
+
+    return ['    ' + line for line in lines]
+
+def _add_step(loop, period, lines):
+    '''add the lines run on the steps of the period'''
+
+    if period == 1:
+        loop += lines
+    else:
+        loop += [f'if s{period}:'] + _indent(lines)
+
+def _gen_source(shape, periods, recorded, every=1, envelope=False,
+        ticks=False, monitored=()):
+    '''
+    source of the run function for the graph shape and periods,
+        recorded -- numbers of the signals with histories,
+        every -- steps between the records, envelope -- the rows of
+            the steps go to the decimator instead, ticks -- tick is
+            called every check steps (see compile_run),
+        monitored -- numbers of the signals checked for the steady
+            state on each step
+    '''
+
+    head, loop, updates, records, tail = [], [], [], [], []
+    # recorded signals of the envelope, constant histories
+    row, fills = [], []
+    nsignals = 1 + max((n for _, _, inps, outps, _ in shape
+            for n in inps + outps), default=-1)
+    for n in range(nsignals):
+        head.append(f'v{n} = signals[{n}]._val')
+        tail.append(f'signals[{n}]._val = v{n}')
+
+    for k, (block_type, source, inps, outps, nstates) in enumerate(shape):
+        period = periods[k]
+        kernel = KERNELS.get((block_type, source))
+        if kernel is None or len(outps) != 1 or (
+                block_type == 'integ' and nstates != 1):
+            # call the block, its inputs are synced before
+            #   and its outputs are read after
+            head.append(f'B{k} = blocks[{k}]')
+            lines = [f'signals[{n}]._val = v{n}' for n in inps]
+            lines += ['try:',
+                      f'    B{k}.update(t, dt)',
+                      'except SimCancelled:',
+                      '    raise',
+                      'except Exception as ex:',
+                      '    print(ex)']
+            lines += [f'v{n} = signals[{n}]._val' for n in outps]
+            if block_type in UPDATES:
+                _add_step(updates, period,
+                        [f'B{k}.update_states(t, {period}*dt)'])
+        else:
+            o = outps[0]
+            names = {'o': f'v{o}', 'p': f'p{k}', 'x': f'x{k}', 'T': f'T{k}'}
+            names.update(zip('ab', (f'v{n}' for n in inps)))
+            code = ''.join(kernel + UPDATES.get(block_type, []))
+            if '{p}' in code:
+                head.append(f'p{k} = blocks[{k}].pars[0]')
+            if '{x}' in code:
+                head.append(f'x{k} = blocks[{k}].states[0]')
+                tail.append(f'blocks[{k}].states[0] = x{k}')
+            if block_type in UPDATES:
+                head.append(f'T{k} = {period}*dt')
+                _add_step(updates, period, [line.format(**names)
+                        for line in UPDATES[block_type]])
+            lines = [line.format(**names) for line in kernel]
+            if block_type in GUARDED:
+                lines = ['try:'] + _indent(lines) + [
+                         'except Exception as ex:',
+                         '    print(ex)']
+        _add_step(loop, period, lines)
+
+        # the histories get the held values too
+        outps = [n for n in outps if n in recorded]
+        if envelope:
+            row += outps
+            continue
+        if outps and (block_type, source) == ('num', True):
+            fills.append(f'signals[{outps[0]}].hist.fill(v{outps[0]}, r)')
+            continue
+        for n in outps:
+            head.append(f'H{n} = signals[{n}].hist.data')
+            records.append(f'H{n}[r] = v{n}')
+            tail.append(f'signals[{n}].hist.close(r)')
+
+    hits = [f's{period} = n % {period} == 0'
+            for period in sorted(set(periods)) if period > 1]
+    if envelope:
+        head.append(f'hists = [{", ".join(f"signals[{n}].hist" for n in row)}]')
+        head.append(f'decimator = Decimator(hists, t_hist, {every}, True, start=n)')
+        head.append('REC = decimator.record')
+        records = [f'if REC(t, ({"".join(f"v{n}, " for n in row)})):',
+                   '    yield']
+        tail = ['decimator.flush()'] + tail
+    else:
+        hists = [line.split(' = ')[1][:-len('.data')]
+                for line in head if line.startswith('H')]
+        grows = [line.replace('.data', '.grow(size)')
+                for line in head if line.startswith('H')]
+        head += [
+            'TH = t_hist.data',
+            'size = len(TH)',
+            'r = t_hist.size',
+        ]
+        records = [
+            'if r == size:',
+            '    # the arrays are full, the caller can take the records,',
+            '    #   the arrays are emptied or they grow for the next ones',
+            '    t_hist.size = r',
+        ] + _indent([f'{hist}.size = r' for hist in hists] + fills) + [
+            '    yield',
+            '    r = t_hist.size',
+            '    if r == size:',
+            '        size = 2*size + 1',
+            '    TH = t_hist.grow(size)',
+        ] + _indent(grows) + records + [
+            'TH[r] = t',
+            'r += 1',
+        ]
+        if every > 1:
+            records = [f'if n % {every} == 0:'] + _indent(records)
+        tail = ['t_hist.close(r)'] + fills + tail
+    if ticks:
+        hits = ['if n % check == 0:', '    tick(t)'] + hits
+    if monitored:
+        head.append('STEADY = steady.check')
+        records += [
+            f'if STEADY(t, ({"".join(f"v{n}, " for n in monitored)})):',
+            '    t += dt',
+            '    n += 1',
+            '    break',
+        ]
+    body = head + [
+        'while t <= tmax:',
+    ] + _indent(hits + loop + updates + records) + [
+        '    t += dt',
+        '    n += 1',
+    ] + tail + ['return n, t']
+    return ('def run(blocks, signals, dt, tmax, t_hist, tick, check, t, n, '
+            'steady):\n' + ''.join(f'    {line}\n' for line in body))
+
+@lru_cache(maxsize=64)
+def _compile(shape, periods, recorded, every=1, envelope=False, ticks=False,
+        monitored=()):
+    '''compile the run function for the graph shape, periods and histories'''
+
+    space = {'Decimator': Decimator, 'SimCancelled': SimCancelled}
+    exec(compile(_gen_source(shape, periods, recorded, every, envelope,
+            ticks, monitored), '<sim run>', 'exec'), space)
+    return space['run']
+
+def compile_run(order, periods=None, every=1, envelope=False):
+    '''
+    run function for the schedule, call it as
+        run(dt, tmax, t_hist, tick=None, check=0, t=0, n=0, steady=None)
+        -> generator, it yields when a chunk of the records is in
+        the histories (see Sim.stream) and returns (n, t) of the next
+        step, tick(t) is called every check steps, t and n -- time
+        and number of the first step, the records are added to t_hist
+        and the histories (see Sim.calc resume), steady -- the run
+        stops once sim_history.Steady finds the monitored signals
+        (see Signal.monitored) steady
+        periods -- steps between the calculations of the blocks,
+            by default each block is calculated on each step,
+        every, envelope -- steps between the records of the histories
+            and the envelope mode (see sim_history.Decimator),
+    the other engines (sim_batch, Sim.run_rect, sim_solvers) are
+        generators with the same arguments,
+    t_hist and the histories of the recorded outputs (see
+        Signal.recorded) must be reset for the records (see
+        sim_history.History.reset)
+    '''
+
+    shape, signals = graph_shape(order)
+    recorded = frozenset(n for n, sig in enumerate(signals) if sig.recorded)
+    periods = tuple(periods or [1]*len(order))
+    monitored = tuple(n for n, sig in enumerate(signals) if sig.monitored)
+
+    def run_schedule(dt, tmax, t_hist, tick=None, check=0, t=0, n=0,
+            steady=None):
+        run = _compile(shape, periods, recorded, every, envelope,
+                tick is not None, monitored if steady is not None else ())
+        return run(order, signals, dt, tmax, t_hist, tick, check, t, n,
+                steady)
+    return run_schedule
+
+
+def _gen_deriv_source(shape):
+    '''
+    source of the derivative function for the stage order shape,
+        integs (not inert blocks) are the states
+    '''
+
+    head, body, dx = [], [], []
+    for k, (block_type, source, inps, outps, nstates) in enumerate(shape):
+        if block_type == 'integ':
+            # the output is the state, nan input means no input
+            i, a = len(dx), f'v[{inps[0]}]'
+            head.append(f'v[{outps[0]}] = x[{i}]')
+            dx.append(f'{a} if {a} == {a} else x[{i}]')
+            continue
+        kernel = KERNELS.get((block_type, source))
+        if kernel is None or len(outps) != 1:
+            outs = ''.join(f'v[{n}], ' for n in outps)
+            ins = ', '.join(f'v[{n}]' for n in inps)
+            body += ['try:',
+                     f'    {outs}= blocks[{k}].output_values(t, [{ins}])',
+                     'except SimCancelled:',
+                     '    raise',
+                     'except Exception as ex:',
+                     '    print(ex)']
+            continue
+        names = {'o': f'v[{outps[0]}]', 'p': f'P[{k}]'}
+        names.update(zip('ab', (f'v[{n}]' for n in inps)))
+        lines = [line.format(**names) for line in kernel]
+        if block_type in GUARDED:
+            body += ['try:'] + ['    ' + line for line in lines] + [
+                     'except Exception as ex:',
+                     '    print(ex)']
+        else:
+            body += lines
+
+    body = head + body + ['return [' + ', '.join(dx) + ']']
+    return ('def deriv(t, x, v, P, blocks):\n' +
+            ''.join(f'    {line}\n' for line in body))
+
+@lru_cache(maxsize=64)
+def compile_deriv(shape):
+    '''
+    derivative function for the stage order shape, call it as
+        deriv(t, x, v, P, blocks) -> dx
+        t -- time, x -- list of integ states,
+        v -- list of signal values, it is updated in place,
+        P -- list of pars[0] of the blocks, blocks -- stage order
+    '''
+
+    space = {'SimCancelled': SimCancelled}
+    exec(compile(_gen_deriv_source(shape), '<sim deriv>', 'exec'), space)
+    return space['deriv']
@@ -0,0 +1,16 @@
+'''
+Exceptions of the simulator.
+
+The engines print the errors of the blocks and go on, SimCancelled
+    stops them (see Sim.check_cancel).
+'''
+
+
+class SimException(Exception):
+    '''Exception that is raised in simulator'''
+    pass
+
+
+class SimCancelled(SimException):
+    '''the run is cancelled by the token of Sim'''
+    pass
@@ -0,0 +1,448 @@
+'''
+Histories of the signal values.
+
+A History keeps the values of a signal for the steps of the last run
+    in an array('d') (array('f') in the float32 mode) preallocated
+    for the steps, a signal with the same value on all the steps
+    keeps one value and the length.
+For runs longer than the memory the histories are kept in files of
+    a scratch directory (see Sim) mapped into memory, their views
+    (see History.view) read the mapping without copies.
+Histories are reset by Sim.calc, the values set while the diagram
+    is built are not recorded.
+A Decimator records only some of the steps, or the min and max of
+    the values between them (envelope), so the full history of
+    a long run is never kept.
+Steady finds the steady state of a run, the engines stop there.
+'''
+
+from array import array
+from math import floor
+from mmap import mmap
+from tempfile import TemporaryFile
+
+import numpy as np
+
+
+# numpy types of the array typecodes
+DTYPES = {'d': np.float64, 'f': np.float32}
+
+# rows per chunk of a Recorder
+CHUNK = 4096
+
+
+def estimate_steps(dt, tmax):
+    '''
+    number of the steps of a run with fixed step dt, the times are
+        accumulated, so there can be more of them
+    '''
+
+    if dt <= 0 or tmax < 0:
+        return 0
+    return int(tmax/dt) + 2
+
+
+class History:
+    '''
+    values of a signal on the steps of the last run
+        data -- array of the values, it can be longer than size,
+            the engines write it by index and then close the history
+        size -- number of the values
+        const -- value of a constant history, data is empty
+        scratch -- directory for the file of the values, data is
+            a memoryview of its mapping, by default they are
+            in memory
+    '''
+
+    __slots__ = ('data', 'size', 'const', 'closed', 'typecode',
+            'scratch', 'file')
+
+    def __init__(self, typecode='d', scratch=None):
+        self.data = array(typecode)
+        self.size = 0
+        self.const = None
+        self.closed = False
+        self.typecode = typecode
+        self.scratch = scratch
+        self.file = None
+
+    def reset(self, size=0, typecode=None, scratch=None):
+        '''
+        drop the values and preallocate the array for size values,
+            scratch -- directory to map them from (see History)
+        '''
+
+        self.typecode = typecode or self.typecode
+        self.scratch = scratch
+        self.size = 0
+        self.const = None
+        self.closed = False
+        self._close_file()
+        if scratch is None:
+            self.data = array(self.typecode, [0])*size
+        else:
+            self._open(size)
+
+    def _open(self, size):
+        '''map a new file for size values'''
+
+        # the file is deleted when it is closed, the mapping stays
+        #   valid for the views of the values
+        self._close_file()
+        self.file = TemporaryFile(dir=self.scratch)
+        self._map(size)
+
+    def _close_file(self):
+        '''close the file, its mapping keeps the values'''
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _map(self, size):
+        '''map the file for size values, the values are kept'''
+
+        nbytes = max(size, 1)*array(self.typecode).itemsize
+        self.file.truncate(nbytes)
+        self.data = memoryview(mmap(self.file.fileno(), nbytes)).cast(
+                self.typecode)
+
+    def grow(self, size):
+        '''make room for size values, returns data'''
+
+        if size > len(self.data):
+            if self.scratch is None:
+                self.data.frombytes(bytes(
+                        (size - len(self.data))*self.data.itemsize))
+            elif self.file is None:
+                # the file of a closed history is closed, the values
+                #   move to a new one
+                vals = np.array(self.view())
+                self._open(size)
+                np.frombuffer(self.data, dtype=vals.dtype)[:len(vals)] = vals
+            else:
+                self._map(size)
+        return self.data
+
+    def fill(self, val, size):
+        '''make a constant history of size values'''
+
+        self.data = array(self.typecode)
+        self._close_file()
+        # the value is stored as the array would store it
+        self.const = array(self.typecode, [val])[0]
+        self.size = size
+        self.closed = True
+
+    def append(self, val):
+        '''add a value'''
+
+        if self.const is not None:
+            self._expand()
+        if self.size == len(self.data):
+            self.grow(2*self.size + 1)
+        self.data[self.size] = val
+        self.size += 1
+        self.closed = False
+
+    def extend(self, vals):
+        '''add the values'''
+
+        vals = np.asarray(vals, dtype=DTYPES[self.typecode])
+        if not len(vals):
+            return
+        if self.const is not None:
+            self._expand()
+        end = self.size + len(vals)
+        np.frombuffer(self.grow(end), dtype=vals.dtype)[self.size:end] = vals
+        self.size = end
+        self.closed = False
+
+    def close(self, size=None):
+        '''
+        the values are written, size -- their number if they are
+            written by index, the unused space is dropped and
+            a constant history keeps one value
+        '''
+
+        if self.closed:
+            return
+        if size is not None:
+            self.size = size
+        if self.scratch is None:
+            del self.data[self.size:]
+        else:
+            # the file keeps its length, unused pages take no space
+            self.data = self.data[:self.size]
+            self._close_file()
+        if self.size > 1:
+            vals = self.view()
+            const = bool((vals == vals[0]).all())
+            del vals
+            if const:
+                self.fill(self.data[0], self.size)
+        self.closed = True
+
+    def _expand(self):
+        '''store a constant history in the array'''
+
+        const, self.const = self.const, None
+        if self.scratch is None:
+            self.data = array(self.typecode, [const])*self.size
+        else:
+            self._open(self.size)
+            np.frombuffer(self.data, dtype=DTYPES[self.typecode])[:] = const
+
+    def reopen(self, size):
+        '''
+        make a closed history ready for size more values, they are
+            written by index after the values or added
+        '''
+
+        if self.const is not None:
+            self._expand()
+        self.grow(self.size + size)
+        self.closed = False
+
+    def drain(self):
+        '''
+        the values as a numpy array, the history is emptied for the next
+            values and keeps its space
+        '''
+
+        vals = np.array(self.view())
+        if self.const is not None:
+            self.data = array(self.typecode)
+            self.const = None
+        self.size = 0
+        self.closed = False
+        return vals
+
+    def view(self):
+        '''
+        the values as a read-only numpy array, it is a view of
+            the array or the mapping, not a copy
+        '''
+
+        dtype = DTYPES[self.typecode]
+        if self.const is not None:
+            vals = np.broadcast_to(np.array(self.const, dtype=dtype),
+                    (self.size,))
+        else:
+            vals = np.frombuffer(self.data, dtype=dtype, count=self.size)
+        vals.flags.writeable = False
+        return vals
+
+    def tolist(self):
+        '''the values as a list'''
+
+        if self.const is not None:
+            return [self.const]*self.size
+        return self.data[:self.size].tolist()
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.tolist()[key]
+        if key < 0:
+            key += self.size
+        if not 0 <= key < self.size:
+            raise IndexError('history index out of range')
+        return self.data[key] if self.const is None else self.const
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __eq__(self, other):
+        # the nans of a held value are equal
+        vals = self.tolist()
+        other = list(other)
+        return len(vals) == len(other) and all(
+                a == b or (a != a and b != b) for a, b in zip(vals, other))
+
+    def __array__(self, dtype=None, copy=None):
+        if copy or dtype is not None:
+            return np.array(self.view(), dtype=dtype)
+        return self.view()
+
+    def __repr__(self):
+        if self.const is not None:
+            return f'History(const={self.const}, size={self.size})'
+        return f'History(size={self.size})'
+
+
+class Recorder:
+    '''
+    records rows of values into histories through a numpy chunk, so
+        the values are not kept as python floats
+        hists -- histories of the columns of the rows
+    '''
+
+    def __init__(self, hists):
+        self.hists = hists
+        self.chunk = np.empty((CHUNK, len(hists)), dtype=np.float64)
+        self.rows = 0
+
+    def record(self, row):
+        '''add a row, true if the chunk is moved into the histories'''
+
+        self.chunk[self.rows] = row
+        self.rows += 1
+        if self.rows == CHUNK:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        '''move the recorded rows into the histories'''
+
+        for k, hist in enumerate(self.hists):
+            hist.extend(self.chunk[:self.rows, k])
+        self.rows = 0
+
+
+class Decimator:
+    '''
+    records the rows of values of the steps into histories and t_hist
+        hists -- histories of the columns of the rows
+        every -- steps between the records, for adaptive steps it
+            is the time, the first step of each interval is recorded
+        envelope -- record the min and the max of the values from
+            a record to the next one instead, both at the time of
+            the record, so fast oscillations are seen in the plots
+        start -- steps of the run before, the records of a resumed
+            run go on after the ones in t_hist
+    '''
+
+    def __init__(self, hists, t_hist, every=1, envelope=False,
+            adaptive=False, start=0):
+        self.recorder = Recorder(hists)
+        self.t_hist = t_hist
+        self.every = every
+        self.envelope = envelope
+        self.adaptive = adaptive
+        self.steps = start
+        # time of the next record for adaptive steps
+        self.next = 0
+        if adaptive and len(t_hist):
+            self.next = (floor(t_hist[-1]/every) + 1)*every
+        # time of the first row of the envelope and the rows since it
+        self.t0 = None
+        self.rows = []
+
+    def record(self, t, row):
+        '''
+        add the row of the step at t, true if a chunk of the records
+            is moved into the histories
+        '''
+
+        if self.adaptive:
+            start = t >= self.next
+            if start:
+                self.next = (floor(t/self.every) + 1)*self.every
+        else:
+            start = not self.steps % self.every
+        self.steps += 1
+
+        if not self.envelope:
+            if start:
+                self.t_hist.append(t)
+                return self.recorder.record(row)
+            return False
+        full = False
+        # a resumed run opens a bucket on its first step
+        if start or self.t0 is None:
+            full = self._record_envelope()
+            self.t0 = t
+        self.rows.append(row)
+        return full
+
+    def record_rows(self, ts, rows):
+        '''
+        add the rows of the steps at the times ts (numpy arrays of
+            a chunk of steps), true if records are moved into
+            the histories
+        '''
+
+        if self.envelope or self.adaptive:
+            full = False
+            for t, row in zip(ts.tolist(), rows.tolist()):
+                full = self.record(t, row) or full
+            return full
+        first = -self.steps % self.every
+        self.steps += len(ts)
+        ts, rows = ts[first::self.every], rows[first::self.every]
+        if not len(ts):
+            return False
+        # the rows of record go first
+        self.recorder.flush()
+        self.t_hist.extend(ts)
+        for k, hist in enumerate(self.recorder.hists):
+            hist.extend(rows[:, k])
+        return True
+
+    def _record_envelope(self):
+        '''
+        record the min and max of the rows since the last record,
+            true if a chunk is moved into the histories
+        '''
+
+        if not self.rows:
+            return False
+        rows = np.array(self.rows, dtype=np.float64).reshape(
+                len(self.rows), len(self.recorder.hists))
+        self.rows = []
+        self.t_hist.append(self.t0)
+        self.t_hist.append(self.t0)
+        # nans are not the min or max
+        full = self.recorder.record(np.fmin.reduce(rows))
+        return self.recorder.record(np.fmax.reduce(rows)) or full
+
+    def flush(self):
+        '''move the recorded rows into the histories'''
+
+        if self.envelope:
+            self._record_envelope()
+        self.recorder.flush()
+
+
+class Steady:
+    '''
+    finds the steady state of a run: the values of the monitored
+        signals (see Signal.monitored) change by at most tol per
+        time unit on all the steps of a window (time)
+        t_steady -- time the steady state began, it is set once
+            the run is steady for the window
+    '''
+
+    def __init__(self, tol, window):
+        self.tol = tol
+        self.window = window
+        # time and values of the last step
+        self.t = None
+        self.row = None
+        # time of the first step of the steady steps
+        self.since = None
+        self.t_steady = None
+
+    def check(self, t, row):
+        '''add the values of the step at t, true if the run is steady'''
+
+        t0, prev = self.t, self.row
+        self.t, self.row = t, row
+        if prev is None or t <= t0:
+            return False
+        lim = self.tol*(t - t0)
+        for val, val0 in zip(row, prev):
+            # held nans do not change
+            if not abs(val - val0) <= lim and (val == val or val0 == val0):
+                self.since = None
+                return False
+        if self.since is None:
+            self.since = t0
+        if t - self.since >= self.window:
+            self.t_steady = self.since
+            return True
+        return False
@@ -0,0 +1,989 @@
+'''
+Solvers for the integ states.
+
+The outputs of the integs are the state vector x, the stage function
+    dx = f(t, x) calculates all the other blocks in the stage order
+    (see Sim.schedule) and returns the inputs of the integs.
+The history of the signals is recorded once per step at (t, x),
+    so all the signals of a step see the same states, or only some
+    of the steps are recorded (see sim_history.Decimator).
+Blocks with zero-crossing functions (see Block.crossings) are events,
+    a step over a sign change is cut at the crossing, which is
+    recorded, and the solver restarts there. The blocks whose inputs
+    are the functions keep their branch during a step (see System.hold).
+    If both sides of the crossed surface push towards it, the states
+    slide on it with the Filippov combination of the two fields until
+    one of them stops pushing (see System.switch).
+The run stops early once the monitored signals are steady (see
+    sim_history.Steady) if asked.
+
+Methods:
+    euler       -- rect_meth in the order of the schedule (default)
+    heun        -- Heun's method (RK2)
+    rk4         -- classic Runge-Kutta method
+    symplectic  -- symplectic (semi-implicit) Euler method
+    leapfrog    -- Strang splitting of the symplectic Euler method
+    rk45        -- Dormand-Prince method with adaptive step, dt is
+                    the first step, the history has the accepted steps
+    ros2        -- 2nd order Rosenbrock method with adaptive step for
+                    stiff systems, uses the Jacobian of the states
+    exact       -- exact solution of linear diagrams (see LinearSystem),
+                    the steps are the powers of expm(M*dt), so
+                    results are exact for any dt
+'''
+
+from collections import deque, namedtuple
+from numbers import Number
+from operator import itemgetter
+from sys import float_info
+
+import numpy as np
+
+try:
+    # works for django
+    from .sim_codegen import graph_shape, compile_deriv
+    from .sim_history import CHUNK, Decimator, estimate_steps
+    from .sim_errors import SimException
+except ImportError:
+    # works outside of django
+    from sim_codegen import graph_shape, compile_deriv
+    from sim_history import CHUNK, Decimator, estimate_steps
+    from sim_errors import SimException
+
+
+# a solver, step(system, t, x, dt, dx) returns the next x,
+#   dx is f(t, x), step is None for the default method,
+#   step of an adaptive method returns (x, error, dx at the new x),
+#   rtol, atol are its default tolerances,
+#   a linear method has no step and runs with run_exact
+Method = namedtuple('Method', ['name', 'order', 'step', 'adaptive',
+        'linear', 'rtol', 'atol'], defaults=[False, False, None, None])
+
+# number of steps and events of a run
+Stats = namedtuple('Stats', ['accepted', 'rejected', 'evals', 'events'],
+        defaults=[0])
+
+# events are located up to EVENT_TOL*(1 + |t|)
+EVENT_TOL = 1e-10
+
+# an adaptive step over a switching (at its ends or inside) is at least
+#   EVENT_STEP*max(tmax, 1), so the error there does not stall the run
+EVENT_STEP = 1e-6
+
+# zero-crossings chatter if CHATTER_EVENTS steps over them are faster
+#   than EVENT_RATE per time unit, as in a sliding mode
+CHATTER_EVENTS = 100
+EVENT_RATE = 1000
+
+# relative shift of the states to the sides of a sliding surface
+SLIDE_DELTA = 1e-8
+
+
+class System:
+    '''
+    states and the stage function of a diagram
+        order -- blocks in the stage order
+        signals -- signals by their numbers
+        x0 -- initial states
+        groups -- indexes of the states which can be updated together
+            by the symplectic methods, a state of a group does not
+            depend on the other states of the group
+        sliding -- zero-crossing function the states slide on (see
+            switch), None if they do not
+    '''
+
+    def __init__(self, order):
+        shape, self.signals = graph_shape(order)
+        self.order = order
+        self._deriv = compile_deriv(shape)
+        self.vals = [sig._val for sig in self.signals]
+        self.pars = [block.pars[0] if block.pars else None for block in order]
+
+        # number of the state of each integ
+        integs = {k: i for i, k in enumerate(
+                k for k, block in enumerate(order) if not block.inert)}
+        self.x0 = np.array([order[k].states[0] for k in integs],
+                dtype=np.float64)
+        self.evals = 0
+        self.shape = shape
+        self.integs = integs
+        # Jacobian and its (t, x), (t, x) of the signals
+        self._jac = self._jac_at = None
+        self._vals_at = None
+
+        # signals written by the stage function and the ones of them
+        #   with histories
+        self.outputs = [n for _, _, _, outps, _ in shape for n in outps]
+        self.recorded = [n for n in self.outputs if self.signals[n].recorded]
+        self._record = itemgetter(*self.recorded) if self.recorded else None
+        self.decimator = None
+        # signals checked for the steady state
+        self.monitored = [n for n in self.outputs
+                if self.signals[n].monitored]
+
+        # blocks with zero-crossing functions and their inputs
+        self.crossing_blocks = [(block, shape[k][2])
+                for k, block in enumerate(order)
+                if block.has_crossings()]
+        self.sliding = None
+        # least rate of the sliding function towards the surface
+        self._push = 0.0
+        # the blocks for the stage function, the ones whose inputs are
+        #   the zero-crossing functions are held during a step (see hold)
+        #   and their first function
+        self._blocks = order
+        self._held_sides = None
+        self._held = []
+        start = 0
+        for block, inps in self.crossing_blocks:
+            if isinstance(block.pars[2], Number):
+                self._held.append((order.index(block), start))
+            start += len(block.crossings([self.vals[n] for n in inps]))
+
+        # states each signal depends on
+        deps = {}
+        for k, (_, _, inps, outps, _) in enumerate(shape):
+            if k in integs:
+                deps[outps[0]] = {integs[k]}
+            else:
+                dep = set().union(*(deps.get(n, set()) for n in inps))
+                for n in outps:
+                    deps[n] = dep
+        self.groups = []
+        group = set()
+        for k, i in integs.items():
+            if (deps.get(shape[k][2][0], set()) - {i}) & group:
+                self.groups.append(np.array(sorted(group), dtype=np.intp))
+                group = set()
+            group.add(i)
+        if group:
+            self.groups.append(np.array(sorted(group), dtype=np.intp))
+
+    def deriv(self, t, x):
+        '''
+        dx = f(t, x), all the signals are updated, on a sliding surface
+            dx is the Filippov combination of the fields of its sides
+            which keeps the states on it
+        '''
+
+        if self.sliding is None:
+            return self._eval(t, x)
+        dx_up, dx_down, up, down = self._sides(t, x, self.sliding)
+        self._push = min(down, -up)
+        alpha = min(max(down/(down - up), 0.0), 1.0) if down != up else 0.5
+        self._eval(t, x)
+        return alpha*dx_up + (1 - alpha)*dx_down
+
+    def _eval(self, t, x, held=True):
+        '''the stage function at (t, x), held -- with the held blocks'''
+
+        self.evals += 1
+        self._vals_at = (t, x)
+        return np.array(self._deriv(t, x.tolist(), self.vals, self.pars,
+                self._blocks if held else self.order), dtype=np.float64)
+
+    def hold(self, g):
+        '''
+        hold the branches of the blocks on the sides of the zero-crossing
+            functions g of the start of a step, so the stages past
+            a crossing do not switch (the crossing ends the step),
+            the function of the sliding is not held
+        '''
+
+        if not self._held:
+            return
+        sides = np.sign(g)
+        if self.sliding is not None:
+            sides[self.sliding] = 0
+        sides = sides.tolist()
+        if self._blocks is not self.order and sides == self._held_sides:
+            return
+        self._held_sides = sides
+        blocks = list(self.order)
+        for k, start in self._held:
+            block = self.order[k]
+            blocks[k] = _Held(block, sides[start:start + len(block.inputs)])
+        self._blocks = blocks
+
+    def release(self):
+        '''the blocks switch at the crossings again'''
+
+        self._blocks = self.order
+
+    def _sides(self, t, x, i):
+        '''
+        the stage function on the sides of the surface of the zero-crossing
+            function i near (t, x) and the rates of the function there,
+            returns (dx above, dx below, rate above, rate below),
+            the sides are found by the gradient of the function
+        '''
+
+        self._eval(t, x, False)
+        g0 = self._crossings()[i]
+        grad = np.zeros(len(x))
+        for j in range(len(x)):
+            eps = SLIDE_DELTA*max(1.0, abs(x[j]))
+            shifted = x.copy()
+            shifted[j] += eps
+            self._eval(t, shifted, False)
+            grad[j] = (self._crossings()[i] - g0)/eps
+        norm = grad @ grad
+        if norm == 0:
+            # the function does not depend on the states
+            dx = self._eval(t, x, False)
+            return dx, dx, 0.0, 0.0
+        delta = SLIDE_DELTA*max(1.0, np.abs(x).max())*np.sqrt(norm)
+        dx_up = self._eval(t, x + (delta - g0)/norm*grad, False)
+        dx_down = self._eval(t, x + (-delta - g0)/norm*grad, False)
+        return dx_up, dx_down, grad @ dx_up, grad @ dx_down
+
+    def switch(self, t, x, crossed):
+        '''
+        after an event at (t, x) over the zero-crossing functions
+            crossed: the sliding ends if its function is crossed,
+            else the states slide on the first crossed function whose
+            sides both push towards its surface,
+        returns dx and the zero-crossing functions at (t, x)
+        '''
+
+        self.release()
+        if self.sliding is not None:
+            if self.sliding in crossed:
+                self.sliding = None
+        else:
+            for i in crossed:
+                _, _, up, down = self._sides(t, x, i)
+                if up < 0 < down:
+                    self.sliding = i
+                    break
+        dx = self.deriv(t, x)
+        return dx, self.crossings()
+
+    def jacobian(self, t, x):
+        '''
+        d(dx)/dx at (t, x) as blocks of independent states,
+            a list of (state indexes, dense block)
+        '''
+
+        if self._jac_at is not None and self._jac_at[0] == t \
+                and self._jac_at[1] is x:
+            return self._jac
+        if self.sliding is not None:
+            # the Filippov field by finite differences
+            dx = self.deriv(t, x)
+            jac = np.zeros((len(x), len(x)))
+            for j in range(len(x)):
+                eps = 1.5e-8*max(1.0, abs(x[j]))
+                shifted = x.copy()
+                shifted[j] += eps
+                jac[:, j] = (self.deriv(t, shifted) - dx)/eps
+            self.deriv(t, x)
+            self._jac = [(np.arange(len(x)), jac)]
+            self._jac_at = (t, x)
+            return self._jac
+        if self._vals_at is None or self._vals_at[0] != t \
+                or self._vals_at[1] is not x:
+            self.deriv(t, x)
+        rows = self.sensitivities(t)
+        dx_rows = [None]*len(self.integs)
+        for k, i in self.integs.items():
+            a = self.shape[k][2][0]
+            dx_rows[i] = rows.get(a, {}) if self.vals[a] == self.vals[a] \
+                    else {i: 1.0}
+
+        # states connected through the Jacobian
+        parent = list(range(len(dx_rows)))
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+        for i, row in enumerate(dx_rows):
+            for j in row:
+                parent[find(i)] = find(j)
+        comps = {}
+        for i in range(len(dx_rows)):
+            comps.setdefault(find(i), []).append(i)
+
+        blocks = []
+        for idx in comps.values():
+            pos = {i: p for p, i in enumerate(idx)}
+            jac = np.zeros((len(idx), len(idx)))
+            for p, i in enumerate(idx):
+                for j, val in dx_rows[i].items():
+                    jac[p, pos[j]] = val
+            blocks.append((np.array(idx, dtype=np.intp), jac))
+        self._jac, self._jac_at = blocks, (t, x)
+        return blocks
+
+    def sensitivities(self, t):
+        '''
+        derivatives of the signals by the states as sparse rows
+            {state: value}, the signals must be calculated at (t, x),
+            the rows are exact for the inlined blocks and found by
+            finite differences for the other blocks
+        '''
+
+        v = self.vals
+        rows = {}
+        for k, (block_type, source, inps, outps, _) in enumerate(self.shape):
+            if k in self.integs:
+                rows[outps[0]] = {self.integs[k]: 1.0}
+                continue
+            ins = [rows.get(n, {}) for n in inps]
+            if not any(ins):
+                # sources and blocks which do not depend on the states
+                continue
+            rule = SENSITIVITIES.get((block_type, source))
+            if rule is not None:
+                vals = [v[n] for n in inps]
+                rows[outps[0]] = rule(self.pars[k], vals, ins)
+                continue
+            # finite differences by the inputs which depend on the states
+            vals = [v[n] for n in inps]
+            base = [v[n] for n in outps]
+            outs = [{} for _ in outps]
+            for j, row in enumerate(ins):
+                if not row:
+                    continue
+                delta = 1.5e-8*max(1.0, abs(vals[j]))
+                shifted = vals[:]
+                shifted[j] += delta
+                new = self.order[k].output_values(t, shifted)
+                for out, b, n in zip(outs, base, new):
+                    _add_row(out, (n - b)/delta, row)
+            for n, out in zip(outps, outs):
+                rows[n] = out
+        return rows
+
+    def crossings(self):
+        '''
+        values of the zero-crossing functions for the signals, the one
+            of the sliding is the least rate towards its surface, so
+            the sliding ends at its zero-crossing
+        '''
+
+        g = self._crossings()
+        if self.sliding is not None:
+            g[self.sliding] = self._push
+        return g
+
+    def _crossings(self):
+        '''values of the zero-crossing functions of the blocks'''
+
+        vals = self.vals
+        return np.array([g for block, inps in self.crossing_blocks
+                for g in block.crossings([vals[n] for n in inps])],
+                dtype=np.float64)
+
+    def start(self, t_hist, every=1, envelope=False, adaptive=False, n=0):
+        '''
+        start the history, every, envelope and n (the steps before)
+            are for sim_history.Decimator, for adaptive steps every
+            is the time
+        '''
+
+        self.decimator = Decimator(
+                [self.signals[n].hist for n in self.recorded],
+                t_hist, every, envelope, adaptive, n)
+
+    def record(self, t):
+        '''
+        add the signal values at t to the history, true if a chunk of
+            the records is moved into the histories
+        '''
+
+        return self.decimator.record(t, self._record(self.vals)
+                if self._record else ())
+
+    def steady(self, t, steady):
+        '''
+        true if the run is steady at t, steady -- sim_history.Steady
+            of the monitored signals
+        '''
+
+        vals = self.vals
+        return steady.check(t, [vals[n] for n in self.monitored])
+
+    def finish(self, x):
+        '''move the history, values and states into the blocks'''
+
+        self.decimator.flush()
+        for n in self.outputs:
+            self.signals[n]._val = self.vals[n]
+        states = iter(x.tolist())
+        for block in self.order:
+            if not block.inert:
+                block.states[0] = next(states)
+
+
+class _Held:
+    '''
+    a block whose inputs are its zero-crossing functions with
+        the branches held on the sides (signs, 0 is not held),
+        an input past its side is moved back next to the surface
+    '''
+
+    def __init__(self, block, sides):
+        self.block = block
+        self.sides = sides
+
+    def output_values(self, t, vals):
+        '''outputs of the block for the input values on the held sides'''
+
+        vals = [val if not side or side*val > 0 else side*float_info.min
+                for val, side in zip(vals, self.sides)]
+        return self.block.output_values(t, vals)
+
+
+def _add_row(out, coef, row):
+    '''out += coef*row for sparse rows'''
+
+    for j, val in row.items():
+        out[j] = out.get(j, 0.0) + coef*val
+
+def _combine(*terms):
+    '''sum of coef*row for (coef, row) terms'''
+
+    out = {}
+    for coef, row in terms:
+        _add_row(out, coef, row)
+    return out
+
+# derivatives of the inlined blocks by the states,
+#   rule(pars[0], input values, input rows) -> output row
+SENSITIVITIES = {
+    ('num', False):     lambda p, u, r: _combine((p, r[0])),
+    ('add', False):     lambda p, u, r: _combine((1, r[0]), (1, r[1])),
+    ('sub', False):     lambda p, u, r: _combine((1, r[0]), (-1, r[1])),
+    ('mult', False):    lambda p, u, r: _combine((u[1], r[0]), (u[0], r[1])),
+    ('div', False):     lambda p, u, r: _combine((1/u[1], r[0]),
+                                                 (-u[0]/u[1]**2, r[1])),
+    ('disp', False):    lambda p, u, r: _combine((1, r[0])),
+}
+
+
+def _const(row):
+    '''true if the row of a linear signal has the constant only'''
+
+    return not row[:-1].any()
+
+def _linear_mult(p, r):
+    '''product is linear if one of the factors is constant'''
+
+    if _const(r[0]):
+        return r[0][-1]*r[1]
+    if _const(r[1]):
+        return r[1][-1]*r[0]
+    return None
+
+def _linear_div(p, r):
+    '''quotient is linear for a constant non-zero divisor'''
+
+    if _const(r[1]) and r[1][-1] != 0:
+        return r[0]/r[1][-1]
+    return None
+
+# rows of the outputs of the linear blocks by z = [states, t, 1],
+#   rule(pars[0], input rows) -> output row, None if the block is
+#   not linear for its inputs, sources get the row of 1
+LINEAR = {
+    ('num', True):      lambda p, r: p*r[0],
+    ('num', False):     lambda p, r: p*r[0],
+    ('add', False):     lambda p, r: r[0] + r[1],
+    ('sub', False):     lambda p, r: r[0] - r[1],
+    ('disp', False):    lambda p, r: r[0],
+    ('mult', False):    _linear_mult,
+    ('div', False):     _linear_div,
+}
+
+
+class LinearSystem:
+    '''
+    state-space model of a diagram of linear blocks (see LINEAR),
+        dz/dt = M z for z = [integ states, t, 1], so the inputs
+        (constants and time) are states too, the signals are C z
+        order, signals, x0 -- as for System
+        nonlinear -- first block which is not linear, M and C are
+            None then
+        outputs -- numbers of the signals written by the blocks,
+            C has their rows
+    '''
+
+    def __init__(self, order):
+        shape, self.signals = graph_shape(order)
+        self.order = order
+        integs = [k for k, block in enumerate(order) if not block.inert]
+        self.x0 = np.array([order[k].states[0] for k in integs],
+                dtype=np.float64)
+        self.outputs = [n for _, _, _, outps, _ in shape for n in outps]
+        self.nonlinear = None
+        self.m = self.c = None
+
+        size = len(integs) + 2
+        eye = np.eye(size)
+        rows = {shape[k][3][0]: eye[i] for i, k in enumerate(integs)}
+        # dt/dt = 1
+        m = np.zeros((size, size))
+        m[-2, -1] = 1
+        for k, (block_type, source, inps, outps, _) in enumerate(shape):
+            if not order[k].inert:
+                continue
+            if block_type == 'time':
+                rows[outps[0]] = eye[-2]
+                continue
+            rule = LINEAR.get((block_type, source))
+            ins = [eye[-1]] if source else [rows.get(n) for n in inps]
+            row = None
+            if rule is not None and all(r is not None for r in ins):
+                row = rule(order[k].pars[0] if order[k].pars else None, ins)
+            if row is None:
+                self.nonlinear = order[k]
+                return
+            rows[outps[0]] = row
+        for i, k in enumerate(integs):
+            # an unconnected input is no input, the state is integrated
+            m[i] = rows.get(shape[k][2][0], eye[i])
+        self.m = m
+        self.c = np.array([rows[n] for n in self.outputs]).reshape(
+                len(self.outputs), size)
+
+
+def run_fixed(order, method, dt, tmax, t_hist, every=1, envelope=False,
+        tick=None, check=0, t=0, n=0, steady=None):
+    '''
+    simulate with fixed step dt, times are the same as for rect_meth
+        plus the times of the events, the arguments are as for
+        sim_codegen.compile_run, returns (Stats, t, n),
+        a resumed run (n > 0) has the record of t
+    '''
+
+    system = System(order)
+    system.start(t_hist, every, envelope, n=n)
+    x = system.x0
+    accepted = events = 0
+    # times of the last events
+    times = deque(maxlen=CHATTER_EVENTS)
+    if t <= tmax:
+        dx = system.deriv(t, x)
+        g = system.crossings()
+        if not n and system.record(t):
+            yield
+    on_grid = True
+    # the times of the grid are accumulated as in rect_meth
+    t_next = t + dt
+    while t_next <= tmax:
+        if tick is not None and not accepted % check:
+            tick(t)
+        while True:
+            system.hold(g)
+            x_new = method.step(system, t, x, dt if on_grid else t_next - t, dx)
+            dx_new = system.deriv(t_next, x_new)
+            g_new = system.crossings()
+            if len(_crossed(g, g_new)):
+                _chatter(times, t_next)
+            event = _locate(system, method, t, x, dx, g,
+                    t_next, x_new, g_new)
+            accepted += 1
+            if event is None:
+                break
+            # restart at the event
+            crossed = _crossed(g, event[3])
+            t, x, _, _ = event
+            dx, g = system.switch(t, x, crossed)
+            if system.record(t):
+                yield
+            events += 1
+            on_grid = False
+        t, x, dx, g = t_next, x_new, dx_new, g_new
+        if system.record(t):
+            yield
+        if steady is not None and system.steady(t, steady):
+            break
+        on_grid = True
+        t_next += dt
+    system.finish(x)
+    return (Stats(accepted, 0, system.evals, events), t,
+            system.decimator.steps)
+
+
+def run_adaptive(order, method, dt, tmax, t_hist, rtol=None, atol=None,
+        every=None, envelope=False, tick=None, check=0, t=0, n=0,
+        steady=None):
+    '''
+    simulate from t to tmax with the step chosen by the error estimate,
+        the error of each state must be below atol + rtol*|x|,
+        by default the tolerances of the method,
+        it is a generator as run_fixed, every -- time between
+        the records of the history, by default each step is recorded,
+        check counts the rejected steps too
+    '''
+
+    rtol = method.rtol if rtol is None else rtol
+    atol = method.atol if atol is None else atol
+    system = System(order)
+    if every:
+        system.start(t_hist, every, envelope, adaptive=True, n=n)
+    else:
+        system.start(t_hist, envelope=envelope, n=n)
+    accepted = rejected = events = 0
+    # the step can not be less than hmin, after a step over
+    #   a zero-crossing less than hevent
+    hmin = 1e-12*max(tmax, 1)
+    hevent = EVENT_STEP*max(tmax, 1)
+    switching = False
+    times = deque(maxlen=CHATTER_EVENTS)
+
+    x, h = system.x0, dt
+    dx = system.deriv(t, x)
+    g = system.crossings()
+    if not n and system.record(t):
+        yield
+    while t < tmax:
+        if tick is not None and not (accepted + rejected) % check:
+            tick(t)
+        last = t + h >= tmax
+        if last:
+            h = tmax - t
+        system.hold(g)
+        x_new, err, dx_new = method.step(system, t, x, h, dx)
+        scale = atol + rtol*np.maximum(np.abs(x), np.abs(x_new))
+        err = np.sqrt(np.mean((err/scale)**2)) if len(x) else 0.0
+        if err <= 1 or switching and h <= hevent:
+            # the last stage is at the new x, so are the signals
+            accepted += 1
+            t_new = tmax if last else t + h
+            g_new = system.crossings()
+            crossed = len(_crossed(g, g_new)) > 0
+            # steps over a switching, at the ends or inside
+            if crossed or switching:
+                _chatter(times, t_new)
+            switching = crossed
+            event = _locate(system, method, t, x, dx, g, t_new, x_new, g_new)
+            if event is None:
+                t, x, dx, g = t_new, x_new, dx_new, g_new
+            else:
+                crossed = _crossed(g, event[3])
+                t, x, _, _ = event
+                dx, g = system.switch(t, x, crossed)
+                events += 1
+            if system.record(t):
+                yield
+            if steady is not None and system.steady(t, steady):
+                break
+            factor = 5 if err == 0 else min(5, 0.9*err**(-1/method.order))
+            h *= max(factor, 0.2)
+        else:
+            rejected += 1
+            if not switching:
+                # a switching inside the step, the stages are on both
+                #   sides of it, the Euler step over it crosses
+                system.deriv(t + h, x + h*dx)
+                switching = len(_crossed(g, system.crossings())) > 0
+            # nan error is not less than 1
+            factor = 0.9*err**(-1/method.order) if err == err else 0.2
+            h *= min(max(factor, 0.2), 0.9)
+            if h < hmin:
+                raise FloatingPointError(f'step {h} is too small at t = {t}')
+        if switching:
+            # the steps over the switching are not cut further
+            h = max(h, hevent)
+    system.finish(x)
+    return (Stats(accepted, rejected, system.evals, events), t,
+            system.decimator.steps)
+
+
+# coefficients of the (6, 6) Pade approximant of exp
+PADE = [1, 1/2, 5/44, 1/66, 1/792, 1/15840, 1/665280]
+
+def expm(a):
+    '''
+    matrix exponential by scaling and squaring, a/2**s with the norm
+        below 1/2 gets the Pade approximant, which is squared s times
+    '''
+
+    norm = np.abs(a).sum(1).max() if a.size else 0.0
+    s = max(0, int(np.ceil(np.log2(norm/0.5)))) if norm > 0.5 else 0
+    a = a/2**s
+    eye = np.eye(len(a))
+    num, den, power = eye.copy(), eye.copy(), eye
+    for k, c in enumerate(PADE[1:], 1):
+        power = power @ a
+        num += c*power
+        den += (-1)**k*c*power
+    e = np.linalg.solve(den, num)
+    for _ in range(s):
+        e = e @ e
+    return e
+
+def _advance(z, powers, size):
+    '''
+    states of size steps after z, powers -- Ad**(2**j), the next ones
+        are added as needed, each doubling of the steps is one
+        product by a power
+    '''
+
+    zs = np.empty((size, len(z)))
+    zs[0] = powers[0] @ z
+    done, j = 1, 0
+    while done < size:
+        if j == len(powers):
+            powers.append(powers[-1] @ powers[-1])
+        m = min(done, size - done)
+        zs[done:done + m] = zs[:m] @ powers[j].T
+        done += m
+        j += 1
+    return zs
+
+def run_exact(system, dt, tmax, t_hist, every=1, envelope=False,
+        tick=None, check=0, t=0, n=0, steady=None):
+    '''
+    simulate a linear diagram (see LinearSystem) with fixed step dt,
+        z of the next step is Ad z for Ad = expm(M*dt), the steps are
+        calculated in chunks at once, the times are the same as for
+        run_fixed, it is a generator as run_fixed,
+        every, envelope, tick, t, n, steady -- as for run_fixed
+    '''
+
+    signals = system.signals
+    rows = dict(zip(system.outputs, system.c))
+    recorded = [n for n in system.outputs if signals[n].recorded]
+    monitored = [n for n in system.outputs if signals[n].monitored]
+    rec = np.array([rows[k] for k in recorded]).reshape(
+            len(recorded), len(system.m))
+    mon = np.array([rows[k] for k in monitored]).reshape(
+            len(monitored), len(system.m))
+    decimator = Decimator([signals[k].hist for k in recorded], t_hist,
+            every, envelope, start=n)
+    z = np.concatenate((system.x0, [t, 1.0]))
+    powers = [expm(system.m*dt)]
+    accepted = 0
+    if t <= tmax and not n and decimator.record(t, (rec @ z).tolist()):
+        yield
+    while True:
+        # the times of the grid are accumulated as in rect_meth
+        ts = np.cumsum([t] + [dt]*min(CHUNK, estimate_steps(dt, tmax - t)))
+        size = int(np.searchsorted(ts, tmax, side='right')) - 1
+        if size <= 0:
+            break
+        ts = ts[1:size + 1]
+        zs = _advance(z, powers, size)
+        zs[:, -2] = ts
+        times = ts.tolist()
+        stop = False
+        if steady is not None:
+            for i, row in enumerate((zs @ mon.T).tolist()):
+                if steady.check(times[i], row):
+                    size, stop = i + 1, True
+                    ts, zs = ts[:size], zs[:size]
+                    break
+        if tick is not None:
+            for i in range(-accepted % check, size, check):
+                tick(times[i - 1] if i else t)
+        accepted += size
+        t, z = times[size - 1], zs[-1]
+        if decimator.record_rows(ts, zs @ rec.T):
+            yield
+        if stop:
+            break
+    decimator.flush()
+    for k, val in zip(system.outputs, (system.c @ z).tolist()):
+        signals[k]._val = val
+    states = iter(z[:-2].tolist())
+    for block in system.order:
+        if not block.inert:
+            block.states[0] = next(states)
+    return Stats(accepted, 0, 0, 0), t, decimator.steps
+
+
+def _chatter(times, t):
+    '''
+    add the time of a step over a zero-crossing to the times of the
+        last ones, raise SimException if they chatter (see EVENT_RATE)
+    '''
+
+    times.append(t)
+    span = t - times[0]
+    if len(times) == times.maxlen and span < times.maxlen/EVENT_RATE:
+        raise SimException(f'events chatter at t = {t:g}: {len(times)} ' +
+                f'zero-crossings in {span:g}, they switch faster ' +
+                'than the steps')
+
+def _crossed(g0, g1):
+    '''indexes of the functions which change sign from g0 to g1'''
+
+    return np.flatnonzero(((g0 < 0) & (g1 >= 0)) | ((g0 > 0) & (g1 <= 0)))
+
+def _locate(system, method, t, x, dx, g, t1, x1, g1):
+    '''
+    first zero crossing in the step from (t, x) to (t1, x1), the
+        functions are g at t and g1 at t1, the crossing is bracketed,
+        the steps to the left end do not cross, so the functions there
+        are smooth and the next point is by the secant of the last two
+        left ends (by regula falsi before), the functions at the right
+        end can jump, the bracket is bisected if it does not halve in
+        two iterations,
+    returns (t, x, dx, g) right after the crossing or None if there
+        is no crossing or it is right at t (a switching which
+        repeats every step is not an event)
+    '''
+
+    if not len(_crossed(g, g1)):
+        return None
+    tol = EVENT_TOL*(1 + abs(t1))
+    tl, xl, dxl, gl = t, x, dx, np.asarray(g, dtype=float)
+    tr, gr = t1, np.asarray(g1, dtype=float)
+    # the previous left end and the widths of the bracket
+    tp = gp = None
+    widths = [np.inf, np.inf]
+    while tr - tl > tol:
+        crossed = _crossed(gl, gr)
+        if tr - tl > widths[-2]/2:
+            tm = (tl + tr)/2
+        elif gp is None:
+            tm = min(tl + (tr - tl)*gl[i]/(gl[i] - gr[i]) for i in crossed)
+        else:
+            tm = min((tl - (tl - tp)*gl[i]/(gl[i] - gp[i])
+                    for i in crossed if gl[i] != gp[i]), default=tr)
+        tm = min(max(tm, tl + tol/2), tr - tol/2)
+        widths.append(tr - tl)
+        xm = method.step(system, t, x, tm - t, dx)
+        if method.adaptive:
+            xm = xm[0]
+        dxm = system.deriv(tm, xm)
+        gm = np.asarray(system.crossings(), dtype=float)
+        if len(_crossed(gl, gm)):
+            tr, gr = tm, gm
+        else:
+            tp, gp = tl, gl
+            tl, xl, dxl, gl = tm, xm, dxm, gm
+    if tr - t <= tol:
+        # restore the signals at the end of the step
+        system.deriv(t1, x1)
+        return None
+
+    # the stages of a step to tr can be on the other side of the
+    #   crossing, so the state after it is found from the left end
+    gap = tr - tl
+    for _ in range(64):
+        xs = xl + (tr - tl)*dxl
+        dxs = system.deriv(tr, xs)
+        gs = system.crossings()
+        if len(_crossed(gl, gs)):
+            break
+        tr += gap
+        gap *= 2
+    return tr, xs, dxs, gs
+
+
+def heun_step(system, t, x, dt, dx):
+    '''Heun's method'''
+
+    dx2 = system.deriv(t + dt, x + dt*dx)
+    return x + dt/2*(dx + dx2)
+
+def rk4_step(system, t, x, dt, dx):
+    '''classic Runge-Kutta method'''
+
+    k2 = system.deriv(t + dt/2, x + dt/2*dx)
+    k3 = system.deriv(t + dt/2, x + dt/2*k2)
+    k4 = system.deriv(t + dt, x + dt*k3)
+    return x + dt/6*(dx + 2*k2 + 2*k3 + k4)
+
+def _update(system, t, x, dt, groups, dx=None):
+    '''update the groups of states one by one'''
+
+    x = x.copy()
+    for group in groups:
+        if dx is None:
+            dx = system.deriv(t, x)
+        x[group] += dt*dx[group]
+        dx = None
+    return x
+
+def symplectic_step(system, t, x, dt, dx):
+    '''
+    symplectic Euler method, each group of states is updated with
+        the new values of the groups before it
+    '''
+
+    return _update(system, t, x, dt, system.groups, dx)
+
+def leapfrog_step(system, t, x, dt, dx):
+    '''
+    half a step for all the groups but the last one, a step for the
+        last group and half a step back in the reverse order
+    '''
+
+    groups = system.groups
+    x = _update(system, t, x, dt/2, groups[:-1], dx)
+    x = _update(system, t + dt/2, x, dt, groups[-1:],
+            None if len(groups) > 1 else dx)
+    return _update(system, t + dt, x, dt/2, groups[-2::-1])
+
+# Dormand-Prince tableau
+DP_C = [0, 1/5, 3/10, 4/5, 8/9, 1, 1]
+DP_A = [
+    [],
+    [1/5],
+    [3/40, 9/40],
+    [44/45, -56/15, 32/9],
+    [19372/6561, -25360/2187, 64448/6561, -212/729],
+    [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656],
+    [35/384, 0, 500/1113, 125/192, -2187/6784, 11/84],
+]
+# 5th order weights are the last row of DP_A, E is the difference
+#   with the 4th order weights
+DP_E = [71/57600, 0, -71/16695, 71/1920, -17253/339200, 22/525, -1/40]
+
+def dopri_step(system, t, x, dt, dx):
+    '''Dormand-Prince step, the last stage is dx at the new x'''
+
+    k = [dx]
+    for c, a in zip(DP_C[1:], DP_A[1:]):
+        xs = x + dt*sum(ai*ki for ai, ki in zip(a, k) if ai)
+        k.append(system.deriv(t + c*dt, xs))
+    err = dt*sum(e*ki for e, ki in zip(DP_E, k) if e)
+    return xs, err, k[-1]
+
+# ROS2 of Verwer et al., L-stable
+ROS2_GAMMA = 1 + 2**-0.5
+
+def ros2_step(system, t, x, dt, dx):
+    '''
+    Rosenbrock step, (I - gamma*dt*J)k = f is solved for each block
+        of the Jacobian, the error is the difference with the
+        linearly implicit Euler method, the dependence of f on
+        time is not in the Jacobian
+    '''
+
+    blocks = [(idx, np.linalg.inv(np.eye(len(idx)) - ROS2_GAMMA*dt*jac))
+            for idx, jac in system.jacobian(t, x)]
+
+    def solve(rhs):
+        '''(I - gamma*dt*J)^-1 rhs'''
+
+        out = np.empty_like(rhs)
+        for idx, inv in blocks:
+            out[idx] = inv @ rhs[idx]
+        return out
+
+    k1 = solve(dx)
+    k2 = solve(system.deriv(t + dt, x + dt*k1) - 2*k1)
+    x_new = x + 1.5*dt*k1 + 0.5*dt*k2
+    err = 0.5*dt*(k1 + k2)
+    return x_new, err, system.deriv(t + dt, x_new)
+
+
+METHODS = {
+    'euler':        Method('euler', 1, None),
+    'heun':         Method('heun', 2, heun_step),
+    'rk4':          Method('rk4', 4, rk4_step),
+    'symplectic':   Method('symplectic', 1, symplectic_step),
+    'leapfrog':     Method('leapfrog', 2, leapfrog_step),
+    'rk45':         Method('rk45', 5, dopri_step, True, rtol=1e-6,
+                            atol=1e-9),
+    'ros2':         Method('ros2', 2, ros2_step, True, rtol=1e-3,
+                            atol=1e-6),
+    'exact':        Method('exact', None, None, linear=True),
+}
@@ -0,0 +1,489 @@
+'''
+Bytecode compiler and stack virtual machine for the interpretator.
+
+Compiler turns AST from sim_ast.Parser into a flat list of
+    (opcode, argument) pairs, VM runs it in a dispatch loop.
+User function calls push VM frames instead of recursing
+    in Python, so the recursion depth is limited by MAX_DEPTH only.
+Numbers (constants and variables) are plain floats, a num block
+    is created only when a number is wired into the signal graph
+    (see materialize), a variable holding the number is promoted
+    to that block in place.
+'''
+
+from collections import namedtuple
+import operator
+
+try:
+    # works for django
+    from .simulator import Block, Signal
+    from .parser_utils import sys_funs, logic_funs, to_value
+    from . import sim_ast as ast
+except ImportError:
+    # works outside of django
+    from simulator import Block, Signal
+    from parser_utils import sys_funs, logic_funs, to_value
+    import sim_ast as ast
+
+
+# maximum number of nested user function calls
+MAX_DEPTH = 10000
+
+# opcodes
+(
+    CONST,          # push arg
+    LOAD,           # push var, arg -- name
+    LOAD_SIGNAL,    # push var promoted to a block, arg -- name
+    LOAD_FUN,       # push function, arg -- name
+    STORE,          # store top of the stack, arg -- name
+    POP,            # pop top of the stack
+    BINARY,         # a op b, arg -- (operator function, name of a, name of b)
+    COMPARE,        # a op b, arg -- logic function
+    LOGIC,          # a and b, a or b, arg -- 'and' or 'or'
+    NOT,            # not a
+    NEG,            # -a
+    CHECK_BOOL,     # raise if top of the stack is not a boolean
+    JUMP,           # jump to arg
+    JUMP_IF_FALSE,  # pop and jump to arg if false
+    BUILD_ARRAY,    # pop arg values and push them as a list
+    INDEX,          # a[b]
+    PORT,           # a.in or a.out, arg -- 'inputs' or 'outputs'
+    CALL,           # call function with arg parameters
+    CREATE,         # create block, arg -- block type
+    MAKE_FUN,       # define function, arg -- (name, pars, FunCode)
+    RETURN,         # return top of the stack from the frame
+) = range(21)
+
+OPNAMES = [
+    'CONST', 'LOAD', 'LOAD_SIGNAL', 'LOAD_FUN', 'STORE', 'POP', 'BINARY',
+    'COMPARE', 'LOGIC', 'NOT', 'NEG', 'CHECK_BOOL', 'JUMP',
+    'JUMP_IF_FALSE', 'BUILD_ARRAY', 'INDEX', 'PORT', 'CALL',
+    'CREATE', 'MAKE_FUN', 'RETURN',
+]
+
+BINARY_OPS = {
+    'PLUS':     operator.add,
+    'MINUS':    operator.sub,
+    'TIMES':    operator.mul,
+    'DIVIDE':   operator.truediv,
+    'DOG':      operator.matmul,
+}
+
+def materialize(sim, val):
+    '''turn number val into a num block'''
+
+    return sim.create('num', [val])
+
+
+# compiled code, ops is a list of (opcode, arg)
+Bytecode = namedtuple('Bytecode', ['name', 'ops'])
+
+
+class FunCode:
+    '''bytecode of a function, compiled from its ast.Body on the first call'''
+
+    def __init__(self, name, body):
+        self.name = name
+        self.body = body
+        self._ops = None
+
+    @property
+    def ops(self):
+        '''list of (opcode, arg)'''
+
+        if self._ops is None:
+            self._ops = Compiler().compile(self.body.tree, self.name).ops
+        return self._ops
+
+
+def dis(code):
+    '''disassemble bytecode into a readable string'''
+
+    lines = [f'Bytecode({code.name}):']
+    for inx, (op, arg) in enumerate(code.ops):
+        if op == MAKE_FUN:
+            arg = arg[2].name
+        elif op == BINARY:
+            arg = arg[0].__name__
+        elif op == COMPARE:
+            arg = next(k for k, f in logic_funs.items() if f is arg)
+        lines.append(f'{inx:>4} {OPNAMES[op]:<14}{"" if arg is None else arg}')
+    return '\n'.join(lines)
+
+
+class Fun:
+    '''class for storing functions and calculating them'''
+
+    def __init__(self, name, par_names, code):
+        '''
+        name -- function name
+        par_names -- names of parameters
+        code -- function body, FunCode
+        '''
+
+        self.name = name
+        self._par_names = par_names
+        self._code = code
+
+    def __call__(self, pars, sim, memo_space, sys=False):
+        '''
+        calculate function in sim space using pars as parameters
+            and memo_space as memory space
+        if sys is True then add systems function into name-space
+        '''
+
+        par_space = {k:v for k, v in zip(self._par_names, pars)}
+        space = {**sys_funs} if sys else {}
+        space = {**space, **memo_space, **par_space}
+        return VM(sim, space).run(self._code)
+
+    def __repr__(self):
+        return f'Fun(name={self.name}, pars={tuple(self._par_names)})'
+
+
+class Compiler:
+    '''compiles AST into bytecode'''
+
+    def compile(self, tree, name='<module>'):
+        '''
+        compile ast.Code, the value of the last statement
+            is returned
+        '''
+
+        self.ops = []
+        # starts of enclosing while-loops
+        self.loops = []
+
+        tree = ast.fold(tree)
+
+        if not tree.stmts:
+            self._emit(CONST, None)
+        for inx, stmt in enumerate(tree.stmts):
+            if inx:
+                self._emit(POP)
+            self.stmt(stmt)
+        self._emit(RETURN)
+        return Bytecode(name, self.ops)
+
+    def _emit(self, op, arg=None):
+        '''add instruction and return its index'''
+
+        self.ops.append((op, arg))
+        return len(self.ops) - 1
+
+    def _patch(self, inx, target):
+        '''set jump target of instruction inx'''
+
+        self.ops[inx] = (self.ops[inx][0], target)
+
+    def _body(self, code):
+        '''compile body of an if-statement or a while-loop'''
+
+        for stmt in code.stmts:
+            self.stmt(stmt)
+            self._emit(POP)
+
+    # ----------------STATEMENTS-----------------------
+    # each statement leaves exactly one value on the stack
+
+    def stmt(self, node):
+        '''compile statement'''
+
+        tp = type(node)
+        if tp is ast.Assig:
+            self.expr(node.expr)
+            self._emit(STORE, node.name)
+        elif tp is ast.If:
+            ends = []
+            for statement, body in node.branches:
+                self.expr(statement)
+                self._emit(CHECK_BOOL)
+                skip = self._emit(JUMP_IF_FALSE)
+                self._body(body)
+                ends.append(self._emit(JUMP))
+                self._patch(skip, len(self.ops))
+            if node.orelse:
+                self._body(node.orelse)
+            for inx in ends:
+                self._patch(inx, len(self.ops))
+            self._emit(CONST, None)
+        elif tp is ast.While:
+            start = len(self.ops)
+            self.expr(node.cond)
+            skip = self._emit(JUMP_IF_FALSE)
+            self.loops.append(start)
+            self._body(node.body)
+            self.loops.pop()
+            self._emit(JUMP, start)
+            self._patch(skip, len(self.ops))
+            self._emit(CONST, None)
+        elif tp is ast.Return:
+            self.expr(node.expr)
+            if self.loops:
+                # return inside a while loop only ends the iteration
+                self._emit(POP)
+                self._emit(JUMP, self.loops[-1])
+            else:
+                self._emit(RETURN)
+        elif tp is ast.Def:
+            code = FunCode(node.name, node.body)
+            self._emit(MAKE_FUN, (node.name, node.pars, code))
+        else:
+            raise SyntaxError(f'Unknown statement {node}')
+
+    # ----------------EXPRESSIONS----------------------
+    # each expression pushes exactly one value on the stack
+
+    def _name(self, node):
+        '''name of a variable or None for other expressions'''
+
+        return node.name if type(node) is ast.Name else None
+
+    def expr(self, node):
+        '''compile expression'''
+
+        tp = type(node)
+        if tp is ast.Num or tp is ast.Const:
+            self._emit(CONST, node.value)
+        elif tp is ast.Name:
+            self._emit(LOAD, node.name)
+        elif tp is ast.BinOp:
+            self.expr(node.left)
+            self.expr(node.right)
+            self._emit(BINARY, (BINARY_OPS[node.op],
+                    self._name(node.left), self._name(node.right)))
+        elif tp is ast.Compare:
+            self.expr(node.left)
+            self.expr(node.right)
+            self._emit(COMPARE, logic_funs[node.op])
+        elif tp is ast.Logic:
+            self.expr(node.left)
+            self.expr(node.right)
+            self._emit(LOGIC, node.op)
+        elif tp is ast.Not:
+            self.expr(node.expr)
+            self._emit(NOT)
+        elif tp is ast.Neg:
+            self.expr(node.expr)
+            self._emit(NEG)
+        elif tp is ast.Array:
+            for item in node.items:
+                self.expr(item)
+            self._emit(BUILD_ARRAY, len(node.items))
+        elif tp is ast.Index:
+            self.expr(node.target)
+            self.expr(node.index)
+            self._emit(INDEX)
+        elif tp is ast.Port:
+            if type(node.target) is ast.Name:
+                self._emit(LOAD_SIGNAL, node.target.name)
+            else:
+                self.expr(node.target)
+            self._emit(PORT, node.attr)
+        elif tp is ast.Call:
+            if type(node.target) is ast.Name:
+                self._emit(LOAD_FUN, node.target.name)
+            else:
+                self.expr(node.target)
+            for arg in node.args:
+                self.expr(arg)
+            self._emit(CALL, len(node.args))
+        elif tp is ast.Create:
+            for arg in node.args:
+                self.expr(arg)
+            self._emit(CREATE, node.block_type)
+        else:
+            raise SyntaxError(f'Unknown expression {node}')
+
+
+class VM:
+    '''stack machine running bytecode'''
+
+    def __init__(self, sim, memory):
+        '''
+        sim -- the simulator
+        memory -- memory space with vars and funs
+        '''
+
+        self.sim = sim
+        self.memory = memory
+        # saved (ops, pc, memory, stack) of callers
+        self.frames = []
+        # (memory, stack) of the running frame when a sys fun is called
+        self.current = (memory, [])
+
+    def live_values(self):
+        '''
+        values the running code can still reach,
+            used by Sim.compact to find live blocks
+        '''
+
+        memory, stack = self.current
+        yield from memory.values()
+        yield from stack
+        for _, _, memory, stack in self.frames:
+            yield from memory.values()
+            yield from stack
+
+    def run(self, code):
+        '''run bytecode and return its value'''
+
+        # blocks reachable from this VM are kept by Sim.compact
+        roots = self.sim.roots
+        roots.append(self)
+        try:
+            return self._run(code)
+        finally:
+            roots.remove(self)
+
+    def _run(self, code):
+        '''the dispatch loop'''
+
+        sim = self.sim
+        # token to stop the run (see Sim.check_cancel)
+        cancel = sim.cancel
+        memory = self.memory
+        ops = code.ops
+        pc = 0
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        frames = self.frames = []
+
+        while True:
+            op, arg = ops[pc]
+            pc += 1
+
+            if op == LOAD:
+                if arg not in memory:
+                    # create dummy signal
+                    memory[arg] = sim.create('num', [float('nan')])
+                push(memory[arg])
+            elif op == POP:
+                pop()
+            elif op == STORE:
+                memory[arg] = stack[-1]
+            elif op == BINARY:
+                right = pop()
+                left = stack[-1]
+                if type(left) is float and type(right) is float:
+                    stack[-1] = arg[0](left, right)
+                else:
+                    stack[-1] = self._signal_op(arg, left, right, memory)
+            elif op == COMPARE:
+                right = pop()
+                stack[-1] = arg(to_value(stack[-1]), to_value(right))
+            elif op == JUMP_IF_FALSE:
+                if not pop():
+                    pc = arg
+            elif op == JUMP:
+                # loops jump back, they can be cancelled
+                if arg < pc and cancel is not None:
+                    sim.check_cancel()
+                pc = arg
+            elif op == CHECK_BOOL:
+                if not isinstance(stack[-1], bool):
+                    raise SyntaxError('Expected a boolean value')
+            elif op == CONST:
+                push(arg)
+            elif op == LOAD_SIGNAL:
+                val = memory.get(arg)
+                if val is None:
+                    # create dummy signal
+                    val = memory[arg] = sim.create('num', [float('nan')])
+                elif type(val) is float:
+                    val = memory[arg] = materialize(sim, val)
+                push(val)
+            elif op == LOAD_FUN:
+                push(memory[arg])
+            elif op == CALL:
+                if arg:
+                    pars = stack[-arg:]
+                    del stack[-arg:]
+                else:
+                    pars = []
+                f = pop()
+                if isinstance(f, Fun):
+                    if cancel is not None:
+                        sim.check_cancel()
+                    if len(frames) >= MAX_DEPTH:
+                        raise RecursionError('maximum recursion depth '+
+                                f'of {MAX_DEPTH} calls exceeded')
+                    frames.append((ops, pc, memory, stack))
+                    memory = {**memory, **dict(zip(f._par_names, pars))}
+                    ops, pc = f._code.ops, 0
+                    stack = []
+                    push, pop = stack.append, stack.pop
+                else:
+                    self.current = (memory, stack)
+                    push(f(pars=pars, memo_space=memory, sim=sim))
+            elif op == RETURN:
+                val = pop()
+                if not frames:
+                    return val
+                ops, pc, memory, stack = frames.pop()
+                push, pop = stack.append, stack.pop
+                push(val)
+            elif op == INDEX:
+                num = to_value(pop())
+                val = stack[-1][int(num)]
+                if not isinstance(val, (Fun, Block, list, Signal, float)):
+                    raise SyntaxError('found unknown type in the array ' +
+                            f'"type({val}) = {type(val)}"')
+                stack[-1] = val
+            elif op == PORT:
+                val = stack[-1]
+                if type(val) is float:
+                    val = materialize(sim, val)
+                stack[-1] = getattr(val, arg)
+            elif op == BUILD_ARRAY:
+                if arg:
+                    arr = stack[-arg:]
+                    del stack[-arg:]
+                else:
+                    arr = []
+                push(arr)
+            elif op == LOGIC:
+                right = pop()
+                left = stack[-1]
+                if not (isinstance(left, bool) and isinstance(right, bool)):
+                    raise SyntaxError('Expected a boolean value')
+                stack[-1] = left | right if arg == 'or' else left & right
+            elif op == NOT:
+                stack[-1] = not stack[-1]
+            elif op == NEG:
+                val = stack[-1]
+                if isinstance(val, (Block, Signal, float)):
+                    stack[-1] = -val
+            elif op == CREATE:
+                states = pop()
+                pars = pop()
+                push(sim.create(arg, pars, states))
+            elif op == MAKE_FUN:
+                name, pars, body = arg
+                memory[name] = Fun(name, pars, body)
+                push(memory[name])
+            else:
+                raise SyntaxError(f'Unknown opcode {op}')
+
+    def _signal_op(self, arg, left, right, memory):
+        '''
+        a op b where a or b is not a number,
+            a number meeting a signal becomes a num block and
+            the variable holding it is promoted to the block
+        '''
+
+        fun, lname, rname = arg
+        if type(left) is float:
+            left = materialize(self.sim, left)
+            if lname:
+                memory[lname] = left
+            if isinstance(right, Signal):
+                left = left.outputs[0]
+        elif type(right) is float:
+            right = materialize(self.sim, right)
+            if rname:
+                memory[rname] = right
+            if isinstance(left, Signal):
+                right = right.outputs[0]
+        return fun(left, right)
@@ -16,25 +16,34 @@
 
 from collections import namedtuple
 from numbers import Number
-from math import isclose, isnan
+from math import gcd, isclose, isnan
 
+import numpy as np
 import termplotlib as tpl
 
+try:
+    # works for django
+    from .sim_codegen import compile_run
+    from .sim_batch import compile_batches, use_batches
+    from .sim_solvers import (METHODS, LinearSystem, Stats,
+            run_adaptive, run_exact, run_fixed)
+    from .sim_history import CHUNK, Decimator, History, Steady, estimate_steps
+    from .sim_errors import SimException, SimCancelled
+except ImportError:
+    # works outside of django
+    from sim_codegen import compile_run
+    from sim_batch import compile_batches, use_batches
+    from sim_solvers import (METHODS, LinearSystem, Stats,
+            run_adaptive, run_exact, run_fixed)
+    from sim_history import CHUNK, Decimator, History, Steady, estimate_steps
+    from sim_errors import SimException, SimCancelled
 
-class ReturnException(Exception):
-    '''
-    ReturnException is raised when user defined function
-        returns a value
-    '''
-
-    def __init__(self, val):
-        super().__init__()
-        self.val = val
 
+# steps between the checks of the cancel token and the progress reports
+CHECK_STEPS = 1000
 
-class SimException(Exception):
-    '''Exception that is raised in simulator'''
-    pass
+# steps of the default window of the steady state (see Sim.calc)
+STEADY_STEPS = 100
 
 
 # class Array(list):
@@ -124,21 +133,72 @@ def fun(t, dt, inputs, outputs, pars, states, source):
     '''
     creates a function block from a user function
         pars[0] -- Fun(...),
-        pars[1] -- outputs size
+        pars[1] -- outputs size,
+        pars[2] -- zero-crossings (optional, see Block.crossings)
+    '''
+
+    vals = fun_values(pars, [inp.val for inp in inputs], len(outputs),
+            outputs[0].sim.cancel if outputs else None)
+    for inx in range(len(outputs)):
+        outputs[inx].val = vals[inx]
+
+def fun_values(pars, vals, size=None, cancel=None):
+    '''
+    outputs of a fun block for the input values, cancel -- token of
+        the run (see Sim), it stops the loops of the function
     '''
 
     f = pars[0]
-    sim = Sim()
-    p = [sim.create('num', [inp.val]) for inp in inputs]
+    sim = Sim(cancel=cancel)
+    p = [sim.create('num', [val]) for val in vals]
     outs = f(pars=p, sim=sim, memo_space={}, sys=True)
-    for inx in range(len(outputs)):
-        outputs[inx].val = outs[inx].outputs[0].val
+    return [out if isinstance(out, Number) else out.outputs[0].val
+            for out in outs[:size]]
 
 def disp(t, dt, inputs, outputs, pars, states, source):
     '''display'''
 
     outputs[0].val = inputs[0].val
 
+def delay(t, dt, inputs, outputs, pars, states, source):
+    '''
+    a unit delay, the input of the previous sample
+        pars[0] -- sample time
+    '''
+
+    outputs[0].val = states[0]
+
+def zoh(t, dt, inputs, outputs, pars, states, source):
+    '''
+    a zero-order hold, the input is held between samples
+        pars[0] -- sample time
+    '''
+
+    outputs[0].val = inputs[0].val
+
+def dinteg(t, dt, inputs, outputs, pars, states, source):
+    '''
+    a discrete integrator (forward Euler)
+        pars[0] -- sample time
+    '''
+
+    outputs[0].val = states[0]
+
+
+# discrete blocks' state updates, called after all the blocks
+#   at each sample with dt -- the sample time
+def delay_update(t, dt, inputs, outputs, pars, states, source):
+    '''keep the input for the next sample'''
+
+    if not isnan(inputs[0].val):
+        states[0] = inputs[0].val
+
+def dinteg_update(t, dt, inputs, outputs, pars, states, source):
+    '''integrate the input over the sample'''
+
+    if not isnan(inputs[0].val):
+        states[0] = states[0] + dt*inputs[0].val
+
 
 # blocks
 BLOCK_TYPES = {
@@ -149,8 +209,11 @@ BLOCK_TYPES = {
     'div':      BlockType(True,  False, 2, 1, [], []),
     'mult':     BlockType(True,  False, 2, 1, [], []),
     'time':     BlockType(True,  True,  0, 1, [], []),
-    'fun':      BlockType(True,  True,  1, 1, [None, None], []),
+    'fun':      BlockType(True,  True,  1, 1, [None, None, None], []),
     'disp':     BlockType(True,  False, 1, 1, [], []),
+    'delay':    BlockType(True,  True,  1, 1, [0], [0]),
+    'zoh':      BlockType(True,  False, 1, 1, [0], []),
+    'dinteg':   BlockType(True,  True,  1, 1, [0], [0]),
 }
 
 # functions for blocks
@@ -164,18 +227,76 @@ BLOCK_FUNCTIONS = {
     'time':     time,
     'fun':      fun,
     'disp':     disp,
+    'delay':    delay,
+    'zoh':      zoh,
+    'dinteg':   dinteg,
 }
 
+# state updates of discrete blocks
+STATE_UPDATES = {
+    'delay':    delay_update,
+    'dinteg':   dinteg_update,
+}
+
+# discrete blocks, pars[0] is the sample time
+DISCRETE = {'delay', 'zoh', 'dinteg'}
+
 
 class Sim:
     '''class for creating block schemes and simulating them'''
 
-    def __init__(self):
+    def __init__(self, compiled=True, float32=False, scratch=None,
+            cancel=None, progress=None, check_steps=CHECK_STEPS):
+        '''
+        compiled -- run the simulation with generated code
+            (see sim_codegen) or with numpy batches for wide
+            diagrams (see sim_batch) instead of calling blocks
+            one by one
+        float32 -- keep the histories of the signals as float32
+        scratch -- directory for the files of memory-mapped
+            histories (see sim_history.History), by default
+            the histories are in memory
+        cancel -- token (threading.Event) which stops calc and
+            the interpreter with SimCancelled once it is set
+        progress -- function called with the done part of calc
+            (from 0 to 1)
+        check_steps -- steps between the checks of cancel and
+            the calls of progress
+        '''
+
+        self.compiled = compiled
+        self.float32 = float32
+        self.scratch = scratch
+        self.cancel = cancel
+        self.progress = progress
+        self.check_steps = check_steps
         self.blocks = []
+        # signals with histories (see probe), None -- all signals
+        self.probes = None
+        # names of the variables to probe, the interpreter probes
+        #   them on calc (see parser_utils.calc), None -- they are
+        #   not known from the code (see sim_ast.probe_names)
+        self.probe_names = set()
+        # every and envelope of the calcs of the interpreter
+        #   (see parser_utils.record)
+        self.recording = (None, False)
+        # steady and window of the calcs of the interpreter
+        #   (see parser_utils.steady)
+        self.settling = (None, None)
         self.t_hist = None
+        # time and number of the step the last run ends at,
+        #   a resumed run goes on from them (see calc)
+        self.t = 0
+        self.n = 0
+        # steps of the last run (see sim_solvers.Stats)
+        self.stats = None
+        # time the last run got steady, None if it did not stop
+        #   early (see calc)
+        self.t_steady = None
         # get new id on each call
         self.get_id = decorator_counter()
-
+        # running interpreters, each one has live_values()
+        self.roots = []
 
     def create(self, name, pars=None, states=None):
         '''add block to simulation using name, pars and states'''
@@ -186,40 +307,462 @@ class Sim:
             block.upd_and_calc()
         return block
 
-    def calc(self, dt, tmax):
-        '''simulate the system for tmax time with step dt'''
-
-        t = 0
-        self.t_hist = []
-        self.reset()
-        
-        inf_cycle = False
-        while (not inf_cycle) and t <= tmax:
-            sim_blocks = self.blocks
-            cont_flg = True
-            while sim_blocks:
-                cont_flg = False
-                non_calc = []
-                for block in sim_blocks:
-                    if block.source or block.is_ready():
-                        try:
-                            block.calc(t, dt)
-                        except Exception as ex:
-                            # raise # for debug
-                            print(ex)
-                        cont_flg = True
-                    else:
-                        non_calc.append(block)
-                sim_blocks = non_calc
-
-                if not cont_flg and sim_blocks:
-                    print('-----------inf-cycle-----------')
-                    print(sim_blocks)
-                    print('-------------------------------')
-                    inf_cycle = True
-                    break
-            self.t_hist.append(t)
+    def schedule(self, stages=False):
+        '''
+        order in which the blocks are calculated on each step,
+            sources (num sources, integs, time, fun) do not wait
+            for their inputs and cut the feedback loops, other
+            blocks go after all the blocks they read from,
+        stages -- order for the solvers (see sim_solvers), only
+            integs cut the loops
+        '''
+
+        order = []
+        ready = set()
+        if stages:
+            # unconnected inputs of num sources and integs are ready
+            ready.update(id(inp) for block in self.blocks
+                    for inp in block.inputs if inp.parent is block)
+        waiting = self.blocks
+        while waiting:
+            non_calc = []
+            for block in waiting:
+                if (not block.inert if stages else block.source) or \
+                        all(id(inp) in ready for inp in block.inputs):
+                    order.append(block)
+                    ready.update(id(outp) for outp in block.outputs)
+                else:
+                    non_calc.append(block)
+            if len(non_calc) == len(waiting):
+                unconnected = [block for block in non_calc
+                        if any(inp.parent is block and id(inp) not in ready
+                            and inp not in block.outputs
+                            for inp in block.inputs)]
+                if unconnected:
+                    raise SimException('blocks with unconnected inputs: ' +
+                            ', '.join(f'{b.block_type}{b.id}' for b in unconnected))
+                # the first loop with ready inputs is solved as a whole,
+                #   the loop (and its id) is made for it only
+                for comp in strong_components(non_calc):
+                    blocks = [non_calc[k] for k in sorted(comp)]
+                    inner = {id(outp) for block in blocks
+                            for outp in block.outputs}
+                    if all(id(inp) in ready or id(inp) in inner
+                            for block in blocks for inp in block.inputs):
+                        break
+                else:
+                    raise SimException('algebraic loop between blocks: ' +
+                            ', '.join(f'{b.block_type}{b.id}' for b in non_calc))
+                loop = Loop(blocks, self)
+                order.append(loop)
+                ready.update(id(outp) for outp in loop.outputs)
+                in_loop = {id(block) for block in blocks}
+                non_calc = [b for b in non_calc if id(b) not in in_loop]
+            waiting = non_calc
+        return order
+
+    def calc(self, dt, tmax, method=None, rtol=None, atol=None, every=None,
+            envelope=False, resume=False, steady=None, window=None):
+        '''
+        simulate the system for tmax time with step dt,
+            method -- solver for the integs (see sim_solvers.METHODS),
+                by default states are integrated with rect_meth in
+                the order of the schedule
+            rtol, atol -- tolerances for adaptive methods, by default
+                the ones of the method
+            every -- time between the records of the histories, by
+                default each step is recorded, fixed steps are
+                recorded every round(every/dt) steps
+            envelope -- record the min and max of the values between
+                the records instead, both at the time of the record
+                (see sim_history.Decimator)
+            resume -- go on from the end of the last run (or of the
+                loaded snapshot, see load) to tmax with the same
+                method, the records are added to the histories,
+                by default the run starts at 0 from the states
+            steady -- stop the run once the integ states and the probed
+                signals (see probe) which depend on the states change
+                by at most steady per time unit for window time (by
+                default STEADY_STEPS steps),
+                the run ends at t_steady + window and t_steady is
+                the time the steady state began
+        '''
+
+        for _ in self._run(dt, tmax, method, rtol, atol, every, envelope,
+                resume=resume, steady=steady, window=window):
+            pass
+
+    def stream(self, dt, tmax, method=None, rtol=None, atol=None,
+            every=None, envelope=False, resume=False, steady=None,
+            window=None):
+        '''
+        simulate as calc and yield the records as the simulation
+            advances in chunks of (times, values), values -- dict of
+            numpy arrays of the recorded signals (see probe),
+            the histories are emptied after each chunk
+        '''
+
+        for _ in self._run(dt, tmax, method, rtol, atol, every, envelope,
+                CHUNK, resume, steady, window):
+            yield self._drain()
+        if len(self.t_hist):
+            yield self._drain()
+
+    def _drain(self):
+        '''the chunk of the records in the histories (see stream)'''
+
+        return self.t_hist.drain(), {outp: outp.hist.drain()
+                for block in self.blocks for outp in block.outputs
+                if outp.recorded}
+
+    def _run(self, dt, tmax, method, rtol, atol, every, envelope, size=None,
+            resume=False, steady=None, window=None):
+        '''
+        run the simulation as a generator, it yields when a chunk of
+            the records is in the histories, size -- records preallocated
+            for the histories, by default the estimate of the run,
+            resume, steady, window -- see calc
+        '''
+
+        self.compact()
+        if isinstance(method, str):
+            method = METHODS[method]
+        adaptive = method is not None and method.adaptive
+        # steps between the records of the fixed steps
+        steps = max(1, round(every/dt)) if every and dt > 0 else 1
+
+        # the histories are preallocated for the fixed steps,
+        #   the signals without probes keep the values only
+        if size is None:
+            size = 0 if adaptive else -(-estimate_steps(dt, tmax)//steps)
+            if envelope:
+                size *= 2
+        resume = resume and self.t_hist is not None
+        if resume:
+            self.t_hist.reopen(size)
+        else:
+            self.t, self.n = 0, 0
+            self.t_hist = History()
+            self.t_hist.reset(size, scratch=self.scratch)
+        if steady is not None:
+            steady = Steady(steady,
+                    STEADY_STEPS*dt if window is None else window)
+        self.t_steady = None
+        dynamic = self._dynamic() if steady is not None else set()
+        hists = []
+        for block in self.blocks:
+            for outp in block.outputs:
+                outp.recorded = self.probes is None or outp in self.probes
+                outp.monitored = steady is not None and (
+                        block.block_type == 'integ' or
+                        self.probes is not None and outp in self.probes
+                        and id(outp) in dynamic)
+                hist = outp.hist
+                if resume and outp.recorded:
+                    if len(hist) != len(self.t_hist):
+                        # a new probe has no values before
+                        hist.reset(typecode='f' if self.float32 else 'd',
+                                scratch=self.scratch)
+                        hist.extend([float('nan')]*len(self.t_hist))
+                    hist.reopen(size)
+                else:
+                    hist.reset(size if outp.recorded else 0,
+                            'f' if self.float32 else 'd',
+                            self.scratch if outp.recorded else None)
+                hists.append(hist)
+        def report(t):
+            '''check the cancel token and report the progress'''
+
+            self.check_cancel()
+            if self.progress is not None:
+                self.progress(min(t/tmax, 1.0) if tmax > 0 else 1.0)
+
+        tick = report if self.cancel is not None or \
+                self.progress is not None else None
+
+        try:
+            yield from self._calc(dt, tmax, method, rtol, atol,
+                    every if adaptive else steps, envelope, tick, steady)
+            if steady is not None:
+                self.t_steady = steady.t_steady
+            if self.progress is not None:
+                self.progress(1.0)
+        finally:
+            self.t_hist.close()
+            for hist in hists:
+                hist.close()
+
+    def _dynamic(self):
+        '''
+        ids of the signals which depend on the states of the blocks,
+            the other ones depend on the time only (or are constant)
+            and are not checked for the steady state
+        '''
+
+        readers = {}
+        for block in self.blocks:
+            for inp in block.inputs:
+                readers.setdefault(id(inp), []).append(block)
+        todo = [block for block in self.blocks if block.states]
+        seen = set()
+        dynamic = set()
+        while todo:
+            block = todo.pop()
+            if id(block) in seen:
+                continue
+            seen.add(id(block))
+            for outp in block.outputs:
+                dynamic.add(id(outp))
+                todo.extend(readers.get(id(outp), ()))
+        return dynamic
+
+    def _calc(self, dt, tmax, method, rtol, atol, every, envelope, tick,
+            steady=None):
+        '''
+        run the simulation with the method, every -- steps between
+            the records (time for adaptive methods), tick -- function
+            of the time called every check_steps steps, steady --
+            sim_history.Steady which stops the run
+        '''
+
+        check = self.check_steps
+        if method is not None and method.linear:
+            order = self.schedule(stages=True)
+            system = LinearSystem(order)
+            if system.nonlinear is not None:
+                block = system.nonlinear
+                raise SimException(f'{method.name} method needs linear ' +
+                        f'blocks, not {block.block_type}{block.id}')
+            self.stats, self.t, self.n = yield from run_exact(system, dt,
+                    tmax, self.t_hist, every, envelope, tick, check,
+                    self.t, self.n, steady)
+        elif method is None or method.step is None:
+            order = self.schedule()
+            start = self.n
+            self.n, self.t = yield from self.run_rect(order, dt, tmax,
+                    every, envelope, tick, self.t, self.n, steady)
+            self.stats = Stats(self.n - start, 0, self.n - start)
+        elif any(block.block_type in DISCRETE for block in self.blocks):
+            raise SimException('discrete blocks need the default method, ' +
+                    f'not {method.name}')
+        elif method.adaptive:
+            order = self.schedule(stages=True)
+            self.stats, self.t, self.n = yield from run_adaptive(order,
+                    method, dt, tmax, self.t_hist, rtol, atol, every,
+                    envelope, tick, check, self.t, self.n, steady)
+        else:
+            order = self.schedule(stages=True)
+            self.stats, self.t, self.n = yield from run_fixed(order,
+                    method, dt, tmax, self.t_hist, every, envelope, tick,
+                    check, self.t, self.n, steady)
+        for block in order:
+            block.set_ready()
+        failed = [block for block in order
+                if isinstance(block, Loop) and block.failed]
+        if failed:
+            raise SimException(f'algebraic loop {failed[0]} did not converge')
+
+    def save(self, path):
+        '''
+        write a snapshot of the last run into the file at path: its end
+            time, the states, numeric pars and output values of the
+            blocks and the recorded histories (see load)
+        '''
+
+        snap = {'t': np.array([self.t], dtype=np.float64),
+                'n': np.array([self.n], dtype=np.int64)}
+        states, pars, par_index, npars, vals, recorded = [], [], [], [], [], []
+        for block in self.blocks:
+            states += block.states
+            index = [i for i, par in enumerate(block.pars)
+                    if isinstance(par, Number) and not isinstance(par, bool)]
+            pars += [block.pars[i] for i in index]
+            par_index += index
+            npars.append(len(index))
+            for outp in block.outputs:
+                vals.append(outp._val)
+                recorded.append(outp.recorded and len(outp.hist) > 0)
+                if recorded[-1]:
+                    # constant histories keep one value
+                    hist = outp.hist
+                    snap[f'hist{len(vals) - 1}'] = hist.view()[:1] \
+                            if hist.const is not None else hist.view()
+        snap.update(
+            blocks=np.array([f'{block.block_type}{block.id}'
+                    for block in self.blocks]),
+            states=np.array(states, dtype=np.float64),
+            nstates=np.array([len(block.states) for block in self.blocks],
+                    dtype=np.int64),
+            pars=np.array(pars, dtype=np.float64),
+            par_index=np.array(par_index, dtype=np.int64),
+            npars=np.array(npars, dtype=np.int64),
+            vals=np.array(vals, dtype=np.float64),
+            noutputs=np.array([len(block.outputs) for block in self.blocks],
+                    dtype=np.int64),
+            recorded=np.array(recorded, dtype=bool),
+            t_hist=self.t_hist.view() if self.t_hist is not None
+                    else np.empty(0))
+        with open(path, 'wb') as f:
+            np.savez(f, **snap)
+
+    def load(self, path, pars=True):
+        '''
+        restore the snapshot of save into the same diagram (built by
+            the same code), the blocks are found by type and id,
+            pars -- restore the pars, else the current pars are kept
+            to warm-start with them, calc with resume goes on from
+            the snapshot
+        '''
+
+        blocks = {f'{block.block_type}{block.id}': block
+                for block in self.blocks}
+        typecode = 'f' if self.float32 else 'd'
+        with np.load(path, allow_pickle=False) as snap:
+            states = iter(snap['states'].tolist())
+            par_vals = iter(zip(snap['par_index'].tolist(),
+                    snap['pars'].tolist()))
+            vals = iter(snap['vals'].tolist())
+            recorded = iter(snap['recorded'].tolist())
+            self.t_hist = History()
+            self.t_hist.reset(typecode='d', scratch=self.scratch)
+            self.t_hist.extend(snap['t_hist'])
+            self.t_hist.close()
+            k = 0
+            for key, nstates, npars, noutputs in zip(snap['blocks'].tolist(),
+                    snap['nstates'].tolist(), snap['npars'].tolist(),
+                    snap['noutputs'].tolist()):
+                block = blocks.get(key)
+                if block is None or len(block.states) != nstates or \
+                        len(block.outputs) != noutputs:
+                    raise SimException(f'block {key} of the snapshot is ' +
+                            'not in the diagram')
+                block.states[:] = [next(states) for _ in range(nstates)]
+                for _ in range(npars):
+                    i, par = next(par_vals)
+                    if pars:
+                        block.pars[i] = par
+                for outp in block.outputs:
+                    outp._val = next(vals)
+                    outp.recorded = next(recorded)
+                    hist = outp.hist
+                    hist.reset(typecode=typecode,
+                            scratch=self.scratch if outp.recorded else None)
+                    if outp.recorded:
+                        values = snap[f'hist{k}']
+                        if len(values) == len(self.t_hist):
+                            hist.extend(values)
+                        else:
+                            hist.fill(values[0], len(self.t_hist))
+                    hist.close()
+                    k += 1
+            self.t = snap['t'][0].item()
+            self.n = snap['n'][0].item()
+
+    def check_cancel(self):
+        '''raise SimCancelled if the cancel token is set'''
+
+        if self.cancel is not None and self.cancel.is_set():
+            raise SimCancelled('the run is cancelled')
+
+    def probe(self, *objs):
+        '''
+        record the histories of the signals (or of the outputs of the
+            blocks, lists of them) on calc, once a signal is probed
+            the signals without probes keep only their values
+        '''
+
+        if self.probes is None:
+            self.probes = set()
+        todo = list(objs)
+        while todo:
+            obj = todo.pop()
+            if isinstance(obj, Signal):
+                self.probes.add(obj)
+            elif isinstance(obj, Block):
+                self.probes.update(obj.outputs)
+            elif isinstance(obj, list):
+                todo.extend(obj)
+
+    def run_rect(self, order, dt, tmax, every=1, envelope=False, tick=None,
+            t=0, n=0, steady=None):
+        '''
+        integrate the states with rect_meth in the schedule order,
+            each block is calculated once in its sample period (see
+            sample_periods), discrete states are updated after all
+            the blocks of the step, tick is called every check_steps
+            steps, see sim_codegen.compile_run for the rest
+        '''
+
+        periods = sample_periods(order, dt)
+        check = self.check_steps
+        if self.compiled and use_batches(order, periods):
+            return (yield from compile_batches(order, periods, every,
+                    envelope)(dt, tmax, self.t_hist, tick, check, t, n,
+                    steady))
+        if self.compiled:
+            return (yield from compile_run(order, periods, every, envelope)(
+                    dt, tmax, self.t_hist, tick, check, t, n, steady))
+
+        updates = [(block, period)
+                for block, period in zip(order, periods)
+                if block.block_type in STATE_UPDATES]
+        recorded = [outp for block in order for outp in block.outputs
+                if outp.recorded]
+        monitored = [outp for block in order for outp in block.outputs
+                if outp.monitored]
+        decimator = Decimator([outp.hist for outp in recorded],
+                self.t_hist, every, envelope, start=n)
+        while t <= tmax:
+            if tick is not None and not n % check:
+                tick(t)
+            for block, period in zip(order, periods):
+                # the outputs hold between the samples
+                if not n % period:
+                    try:
+                        block.update(t, dt)
+                    except SimCancelled:
+                        raise
+                    except Exception as ex:
+                        # raise # for debug
+                        print(ex)
+            for block, period in updates:
+                if not n % period:
+                    block.update_states(t, period*dt)
+            if decimator.record(t, [outp.val for outp in recorded]):
+                yield
+            if steady is not None and steady.check(t,
+                    [outp.val for outp in monitored]):
+                t += dt
+                n += 1
+                break
             t += dt
+            n += 1
+        decimator.flush()
+        return n, t
+
+    def compact(self):
+        '''
+        drop blocks which can not affect any live value,
+            a block is live if it is reachable from the roots
+            directly or through the inputs of a live block
+        '''
+
+        if not self.roots:
+            # nothing is known about the user's references
+            return
+        todo = [val for root in self.roots for val in root.live_values()]
+        live = set()
+        while todo:
+            obj = todo.pop()
+            if isinstance(obj, Signal):
+                obj = obj.parent
+            if isinstance(obj, Block):
+                if id(obj) not in live:
+                    live.add(id(obj))
+                    todo.extend(inp.parent for inp in obj.inputs)
+            elif isinstance(obj, list):
+                todo.extend(obj)
+        self.blocks = [block for block in self.blocks if id(block) in live]
 
     def reset(self):
         '''reset all blocks ready flag'''
@@ -243,14 +786,20 @@ class Signal:
         ready -- if true signal have been calculated
                     during this sim
         sim -- the simulator
-        hist -- history of val values (for plots)
+        hist -- history of val values on the steps of the last
+            calc (for plots, see sim_history.History)
+        recorded -- if true the history is recorded (see Sim.probe)
+        monitored -- if true the signal is checked for the steady
+            state (see Sim.calc)
     '''
 
     def __init__(self, parent, sim, val=float('nan')):
         self.ready = False
         self.parent = parent
         self.sim = sim
-        self.hist = []
+        self.hist = History()
+        self.recorded = True
+        self.monitored = False
         self.val = val
 
     @property
@@ -260,7 +809,6 @@ class Signal:
     @val.setter
     def val(self, val):
         self._val = val
-        self.hist.append(val)
 
     def reset(self, flg = False):
         self.ready = flg
@@ -308,6 +856,15 @@ class Signal:
         return d.outputs[0]
 
 
+class Value:
+    '''a signal without history for calculations by values'''
+
+    __slots__ = ('val',)
+
+    def __init__(self, val=float('nan')):
+        self.val = val
+
+
 class Block:
     '''a sim block'''
 
@@ -336,6 +893,10 @@ class Block:
         (self.inert, self.source, inpN, outpN, 
                 def_pars, def_states) = BLOCK_TYPES[block_type]
 
+        # zero-crossings of fun blocks are optional
+        if block_type == 'fun' and pars is not None and len(pars) == 2:
+            pars = [*pars, None]
+
         # try to insert user parameters into block
         if pars == None:
             self.pars = def_pars[:]
@@ -363,7 +924,8 @@ class Block:
 
         self.inputs = [ Signal(self, self.sim) for _ in range(inpN) ]
         self.outputs = [ Signal(self, self.sim) for _ in range(outpN) ]
-        self.const = self.inert
+        # discrete blocks with states are not constant
+        self.const = self.inert and not self.states
 
     def is_ready(self):
         '''return true if all inputs are ready'''
@@ -385,6 +947,15 @@ class Block:
         if not self.source and not self.is_ready():
             return False
 
+        self.update(t, dt)
+
+        # ready up outputs
+        self.set_ready()
+        return True
+
+    def update(self, t, dt):
+        '''calc the outputs without checking the inputs'''
+
         if self.inert: # algebraic calculation
             self.fun(
                 t, dt, self.inputs, 
@@ -400,9 +971,50 @@ class Block:
                 self.states[i] = rect_meth(t, dt, self.states[i], dx12)
                 self.outputs[i].val = self.states[i]
 
-        # ready up outputs
-        self.set_ready()
-        return True
+    def update_states(self, t, dt):
+        '''update the states of a discrete block, dt -- the sample time'''
+
+        STATE_UPDATES[self.block_type](
+            t, dt, self.inputs,
+            self.outputs, self.pars, self.states, self.source
+        )
+
+    def output_values(self, t, vals):
+        '''
+        outputs of the block for the input values,
+            the signals are not changed
+        '''
+
+        if self.block_type == 'fun':
+            return fun_values(self.pars, vals, len(self.outputs),
+                    self.sim.cancel)
+        if not self.inert:
+            raise SimException(f'block {self.block_type} can not be ' +
+                    'calculated by values')
+        inputs = [Value(val) for val in vals]
+        outputs = [Value() for _ in self.outputs]
+        self.fun(t, 0, inputs, outputs, self.pars, self.states, self.source)
+        return [outp.val for outp in outputs]
+
+    def has_crossings(self):
+        '''true if the block has zero-crossing functions'''
+
+        return self.block_type == 'fun' and self.pars[2] is not None \
+                and not (isinstance(self.pars[2], Number) and not self.pars[2])
+
+    def crossings(self, vals):
+        '''
+        values of the zero-crossing functions for the input values,
+            the solvers locate the times where they change sign,
+        for a fun block pars[2] can be a number (the inputs are the
+            functions) or a Fun returning a list of the functions
+        '''
+
+        if not self.has_crossings():
+            return []
+        if isinstance(self.pars[2], Number):
+            return list(vals)
+        return fun_values(self.pars[2:], vals, cancel=self.sim.cancel)
 
     def upd_and_calc(self):
         '''upd block outputs (for const blocks)'''
@@ -485,3 +1097,193 @@ class Block:
 
     def __ge__(self, other):
         return other.__lt__(self) or self.__eq__(other)
+
+
+def sample_periods(order, dt):
+    '''
+    number of steps between the calculations of each block of the
+        schedule, discrete blocks have their sample times rounded
+        to steps, integs, time and loops are calculated on each
+        step, other blocks have the gcd of the periods of their
+        inputs (they can change only then), constant sources do
+        not count and inputs calculated later in the step (the
+        previous step values) give 1
+    '''
+
+    pos = {id(block): k for k, block in enumerate(order)}
+    periods = []
+    for k, block in enumerate(order):
+        if block.block_type in DISCRETE:
+            periods.append(max(1, round(block.pars[0]/dt)))
+            continue
+        if not block.inert or block.block_type in ('time', 'loop'):
+            periods.append(1)
+            continue
+        period = 0
+        for inp in block.inputs:
+            parent = inp.parent
+            j = pos.get(id(parent))
+            if j is None or inp not in parent.outputs or (
+                    parent.block_type == 'num' and parent.source):
+                continue
+            period = gcd(period, periods[j] if j < k else 1)
+        periods.append(period or 1)
+    return periods
+
+
+def strong_components(blocks):
+    '''
+    strongly connected components of the graph of blocks connected
+        by their inputs (Tarjan), the components are lists of block
+        indexes, the components upstream go first
+    '''
+
+    pos = {id(block): k for k, block in enumerate(blocks)}
+    preds = [[pos[id(inp.parent)] for inp in block.inputs
+            if id(inp.parent) in pos and inp in inp.parent.outputs]
+            for block in blocks]
+
+    index = [None]*len(blocks)
+    low = [0]*len(blocks)
+    on_stack = [False]*len(blocks)
+    stack = []
+    comps = []
+    counter = 0
+    for root in range(len(blocks)):
+        if index[root] is not None:
+            continue
+        # (block, next pred to visit) instead of recursion
+        work = [(root, 0)]
+        while work:
+            v, i = work.pop()
+            if i == 0:
+                index[v] = low[v] = counter
+                counter += 1
+                stack.append(v)
+                on_stack[v] = True
+            for j in range(i, len(preds[v])):
+                w = preds[v][j]
+                if index[w] is None:
+                    work += [(v, j + 1), (w, 0)]
+                    break
+                elif on_stack[w]:
+                    low[v] = min(low[v], index[w])
+            else:
+                if low[v] == index[v]:
+                    comp = []
+                    while True:
+                        w = stack.pop()
+                        on_stack[w] = False
+                        comp.append(w)
+                        if w == v:
+                            break
+                    comps.append(comp)
+                if work:
+                    u = work[-1][0]
+                    low[u] = min(low[u], low[v])
+    return comps
+
+
+class Loop:
+    '''
+    an algebraic loop calculated as one block, the outputs of the
+        blocks of the loop are found by Newton's method
+        blocks -- blocks of the loop
+        inputs -- signals from outside of the loop
+        outputs -- outputs of the blocks of the loop
+        failed -- true if a solution did not converge
+    '''
+
+    # tolerance and max number of iterations
+    TOL = 1e-10
+    MAX_ITER = 50
+
+    def __init__(self, blocks, sim):
+        self.block_type = 'loop'
+        self.id = sim.get_id('loop')
+        self.inert, self.source = True, False
+        self.pars, self.states = [], []
+        self.blocks = blocks
+        self.outputs = [outp for block in blocks for outp in block.outputs]
+        self.failed = False
+
+        inner = {id(outp): k for k, outp in enumerate(self.outputs)}
+        self.inputs = []
+        outer = {}
+        # for each block where its inputs are: (True, inner number)
+        #   or (False, input number)
+        self._plan = []
+        for block in blocks:
+            srcs = []
+            for inp in block.inputs:
+                if id(inp) in inner:
+                    srcs.append((True, inner[id(inp)]))
+                else:
+                    if id(inp) not in outer:
+                        outer[id(inp)] = len(self.inputs)
+                        self.inputs.append(inp)
+                    srcs.append((False, outer[id(inp)]))
+            self._plan.append((block, srcs))
+
+    def __repr__(self):
+        return f'Loop(blocks={[f"{b.block_type}{b.id}" for b in self.blocks]})'
+
+    def _eval(self, t, ext, z):
+        '''outputs of the blocks for the inner values z'''
+
+        z = z.tolist()
+        out = []
+        for block, srcs in self._plan:
+            out += block.output_values(t,
+                    [z[k] if inner else ext[k] for inner, k in srcs])
+        return np.array(out, dtype=np.float64)
+
+    def solve(self, t, ext):
+        '''outputs of the loop for the input values ext'''
+
+        z = np.array([outp.val for outp in self.outputs], dtype=np.float64)
+        z[np.isnan(z)] = 0
+        for _ in range(self.MAX_ITER):
+            g = self._eval(t, ext, z)
+            r = g - z
+            if np.all(np.abs(r) <= self.TOL*(1 + np.abs(z))):
+                return g.tolist()
+            # Newton's method for g(z) - z = 0
+            jac = np.empty((len(z), len(z)))
+            for j in range(len(z)):
+                dz = z.copy()
+                delta = 1.5e-8*max(1.0, abs(z[j]))
+                dz[j] += delta
+                jac[:, j] = (self._eval(t, ext, dz) - g)/delta
+            jac -= np.eye(len(z))
+            # the finite differences are exact up to about 1e-8, so
+            #   smaller singular values are zeros
+            if np.linalg.svd(jac, compute_uv=False).min() <= \
+                    1e-6*(1 + np.abs(jac).max()):
+                break
+            z = z - np.linalg.solve(jac, r)
+        self.failed = True
+        return z.tolist()
+
+    def has_crossings(self):
+        '''loops have no zero-crossing functions'''
+
+        return False
+
+    def output_values(self, t, vals):
+        '''outputs of the loop for the input values'''
+
+        return self.solve(t, vals)
+
+    def update(self, t, dt):
+        '''calc the outputs'''
+
+        for outp, val in zip(self.outputs,
+                self.solve(t, [inp.val for inp in self.inputs])):
+            outp.val = val
+
+    def set_ready(self, flg=True):
+        '''set all outputs ready'''
+
+        for outp in self.outputs:
+            outp.reset(flg)
@@ -2,22 +2,41 @@ import unittest
 import io
 from contextlib import redirect_stdout
 import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+
+import numpy as np
 
 from sim_parser import ExpressionEvaluator
+from simulator import Sim, SimCancelled, SimException
+from sim_batch import use_batches
+from sim_solvers import System, expm
+from sim_history import CHUNK
+import parser_utils
+from parser_utils import TOKEN_CODES, generate_tokens, scan_arrays
 
 
-async def parse_code(code_str):
+async def parse_code(code_str, cancel):
     loop = asyncio.get_running_loop()
-    parser = ExpressionEvaluator()
+    parser = ExpressionEvaluator(sim=Sim(cancel=cancel))
     out = await loop.run_in_executor(None, parser.parse, code_str)
     return out
 
 async def run_code(code_str, timeout):
     f = io.StringIO()
+    # stops the worker thread on the timeout
+    cancel = threading.Event()
     with redirect_stdout(f):
         try:
-            await asyncio.wait_for(parse_code(code_str), timeout=timeout)
+            await asyncio.wait_for(parse_code(code_str, cancel),
+                    timeout=timeout)
         except asyncio.TimeoutError:
+            cancel.set()
             print(f'Program was running for more than {timeout} '+
                     'sec and was terminated!')
         except Exception as e:
@@ -45,6 +64,12 @@ x = 3
 print(x)
 ''' # 3
 
+code_keyword_names = '''
+iffy = 3
+notes = 2
+print(iffy + notes)
+''' # 5
+
 code_if = '''
 if 6 > 5 {
     print(1)
@@ -72,6 +97,14 @@ if x > y {
 }
 ''' # 1
 
+code_if5 = '''
+x = 6
+if x > 5 {
+    print(1)
+}
+print(2)
+''' # 1, 2
+
 code_if_else = '''
 x = 6
 if x > 6 {
@@ -170,6 +203,82 @@ while i < 10 {
 }
 ''' # 1, 2, 3, ..., 9
 
+code_deep_recursion = '''
+def f(n) {
+    if n > 0 {
+        return f(n - 1) + 1
+    }
+    return 0
+}
+print(f(3000))
+''' # 3000
+
+code_fun_lazy = '''
+def broken() {
+    print(1 +)
+}
+print(1)
+broken()
+''' # 1, syntax error
+
+code_loop_scalars = '''
+i = 0
+s = 0
+while i < 10000 {
+    s = s + i
+    i = i + 1
+}
+print(s)
+''' # 49995000
+
+code_scalar_wiring = '''
+x = 2
+y = num([3], [])
+e = x + y
+y @ x
+print(x, e)
+''' # 6, 5
+
+code_compact = '''
+def tmp(a) {
+    b = a * 3
+    return 1
+}
+y = integ([], [1.0])
+i = 0
+while i < 100 {
+    z = y * 2 + 1
+    tmp(y)
+    i = i + 1
+}
+y = -y @ y
+calc(0.1, 1)
+print(y)
+''' # 0.9^11
+
+code_algebraic_loop = '''
+x = 1
+a = add([], [])
+x.out[0] @ a.in[0]
+g = a @ num([2], [])
+g.out[0] @ a.in[1]
+calc(0.1, 1)
+print(a, g)
+''' # a = 1 + 2*a, -1, -2
+
+code_bad_loop = '''
+x = 1
+a = add([], [])
+x.out[0] @ a.in[0]
+a.out[0] @ a.in[1]
+calc(0.1, 1)
+''' # a = 1 + a, no solution
+
+code_unconnected = '''
+a = add([], [])
+calc(0.1, 1)
+''' # unconnected error
+
 code_array_fun = '''
 def foo(x) {
     return 33
@@ -353,6 +462,103 @@ calc(0.00001, 3)
 print(y)
 ''' # 1.61094
 
+code_oscillator_rk4 = code_oscillator_web.replace(
+        'calc(0.00001, 3)', 'calc(0.01, 3, rk4)') # 1.61094
+
+code_oscillator_symplectic = code_oscillator_web.replace(
+        'calc(0.00001, 3)', 'calc(0.1, 3, symplectic)') # 1.60634
+
+code_oscillator_euler = code_oscillator_web.replace(
+        'calc(0.00001, 3)', 'calc(0.1, 3)') # 1.60634
+
+code_oscillator_rk45 = code_oscillator_web.replace(
+        'calc(0.00001, 3)', 'calc(0.01, 3, rk45)\nstats()')
+# accepted: 17, rejected: 0, evals: 103, events: 0
+# 1.61094
+
+code_stiff = '''
+x = 1
+y = integ([], [0.0])
+e = x - y
+g = e @ 1000
+g @ y
+dz = integ([], [0.0])
+z = dz @ integ([], [0.0])
+f = y - (dz @ 0.3 + z)
+f @ dz
+calc(0.1, 10, ros2, 0.001, 0.000001)
+print(y)
+''' # 1.0, rk45 needs 3026 steps
+
+code_event = '''
+def rate(x) {
+  if x < 0.5 {
+    return [1]
+  } else {
+    return [2]
+  }
+}
+def switch(x) {
+  return [x - 0.5]
+}
+y = integ([], [0.0])
+u = y @ fun([rate, 1, switch], [])
+u @ y
+calc(0.3, 0.9, rk4)
+stats()
+print(y)
+''' # the rate switches at t = 0.5, 1.3 (1.25 without the event)
+
+code_discrete = '''
+def logic(x) {
+  print(x)
+  return [x*2]
+}
+t = time([], [])
+s = t + 1
+z = s @ zoh([0.5], [])
+d = z @ delay([0.5], [0.0])
+c = dinteg([0.5], [0.0])
+1 @ c
+w = d @ fun([logic, 1], [])
+q = w + c
+y = integ([], [0.0])
+q @ y
+calc(0.25, 2)
+print(y)
+''' # logic runs at the samples only
+
+code_probe = '''
+dy = integ([], [0.0])
+y = dy @ integ([], [0.0])
+e = 1 - (y + 0.5*dy)
+e @ dy
+t = time([], [])
+calc(0.01, 1)
+if 1 > 2 {
+  plot(t, y)
+}
+''' # only t and y are recorded
+
+code_fun_spin = '''
+def spin(x) {
+    while 1 < 2 {
+        x = x + 1
+    }
+    return x
+}
+y = integ([], [0.0])
+u = y @ fun([spin, 1], [])
+'''
+
+code_record = '''
+dy = integ([], [0.0])
+y = dy @ integ([], [0.0])
+e = 1 - (y + 0.5*dy)
+e @ dy
+t = time([], [])
+'''
+
 code_signal_routing_web = '''
 x = num([3], [])
 y = 4
@@ -386,6 +592,24 @@ calc(0.00005, 2)
 print(y)
 ''' # 0.84814
 
+code_wide = ''.join(f'''
+dy{i} = integ([], [0.0])
+y{i} = dy{i} @ integ([], [0.0])
+e{i} = {i} - (y{i} + 0.5*dy{i})
+e{i} @ dy{i}
+d{i} = y{i} / (dy{i} - {i % 3})
+''' for i in range(20)) + '''
+calc(0.01, 1)
+''' # 20 oscillators with divisions by zero
+
+
+def build(code=code_record, compiled=True):
+    '''parse the code with a new Sim, returns the sim and the memory'''
+
+    parser = ExpressionEvaluator(sim=Sim(compiled=compiled))
+    parser.parse(code)
+    return parser.sim, parser.memory
+
 
 class TestParser(unittest.TestCase):
 
@@ -395,9 +619,31 @@ class TestParser(unittest.TestCase):
     def test_mult(self):
         self.assertEqual(float(djex({}, code_mult)), 4)
 
+    def test_scan_arrays(self):
+        # the bulk scanner gives the tokens of generate_tokens
+        for code in [code_fib_web, code_nested_arrays_web, code_if_else_web,
+                code_compact, 'x  =  1\n\t y==x; z = [x , 2.5]']:
+            tokens = list(generate_tokens(code))
+            types, values, lines, cols = scan_arrays(code)
+            self.assertEqual((types.tolist(), values, lines.tolist(),
+                    cols.tolist()), (
+                    [TOKEN_CODES[tok.type] for tok in tokens],
+                    [tok.value for tok in tokens],
+                    [tok.line for tok in tokens],
+                    [tok.col for tok in tokens]))
+
+    def test_const_folding(self):
+        parser = ExpressionEvaluator()
+        with redirect_stdout(io.StringIO()):
+            parser.parse(code_mult)
+        self.assertEqual(parser.sim.blocks, [])
+
     def test_var(self):
         self.assertEqual(float(djex({}, code_var)), 3)
 
+    def test_keyword_names(self):
+        self.assertEqual(float(djex({}, code_keyword_names)), 5)
+
     def test_if(self):
         self.assertEqual(float(djex({}, code_if)), 1)
 
@@ -410,6 +656,9 @@ class TestParser(unittest.TestCase):
     def test_if4(self):
         self.assertEqual(float(djex({}, code_if4)), 1)
 
+    def test_if5(self):
+        self.assertEqual(djex({}, code_if5), '1.0\n2.0\n')
+
     def test_if_else(self):
         self.assertEqual(float(djex({}, code_if_else)), 2)
 
@@ -452,6 +701,446 @@ class TestParser(unittest.TestCase):
     def test_while(self):
         self.assertEqual(djex({}, code_while), '0.0\n1.0\n2.0\n3.0\n4.0\n5.0\n6.0\n7.0\n8.0\n9.0\n')
 
+    def test_deep_recursion(self):
+        self.assertEqual(float(djex({}, code_deep_recursion)), 3000)
+
+    def test_fun_lazy(self):
+        self.assertTrue(djex({}, code_fun_lazy).startswith('1.0\nexpected a number'))
+
+    def test_loop_scalars(self):
+        parser = ExpressionEvaluator()
+        f = io.StringIO()
+        with redirect_stdout(f):
+            parser.parse(code_loop_scalars)
+        self.assertEqual(f.getvalue(), '49995000.0\n')
+        self.assertEqual(parser.sim.blocks, [])
+
+    def test_scalar_wiring(self):
+        self.assertEqual(djex({}, code_scalar_wiring), '6.0 5.0\n')
+
+    def test_compact(self):
+        parser = ExpressionEvaluator()
+        f = io.StringIO()
+        with redirect_stdout(f):
+            parser.parse(code_compact)
+        self.assertEqual(f.getvalue(), '0.31381\n')
+        # y, gain and the last z = y * 2 + 1
+        self.assertEqual(len(parser.sim.blocks), 6)
+
+    def test_compiled_run(self):
+        hists = []
+        for compiled in [True, False]:
+            parser = ExpressionEvaluator(sim=Sim(compiled=compiled))
+            with redirect_stdout(io.StringIO()):
+                parser.parse(code_harmonic_web)
+            hists.append([outp.hist for block in parser.sim.blocks
+                    for outp in block.outputs])
+        self.assertEqual(hists[0], hists[1])
+
+    def test_history(self):
+        code = code_oscillator_web.replace('calc(0.00001, 3)', 'calc(0.01, 3)')
+        for compiled, float32 in [(True, False), (False, False), (True, True)]:
+            parser = ExpressionEvaluator(
+                    sim=Sim(compiled=compiled, float32=float32))
+            with redirect_stdout(io.StringIO()):
+                parser.parse(code)
+                parser.parse('calc(0.01, 3)')
+            # the histories have the steps of the last calc only
+            hist = parser.memory['y'].outputs[0].hist
+            self.assertEqual(len(hist), len(parser.sim.t_hist))
+            self.assertEqual(len(hist), 301)
+            self.assertEqual(hist.data.typecode, 'f' if float32 else 'd')
+            self.assertAlmostEqual(hist[-1], 0.63703, places=4)
+            [one] = [block for block in parser.sim.blocks
+                    if block.block_type == 'num' and block.source]
+            self.assertEqual(one.outputs[0].hist.const, 1)
+            self.assertEqual(len(one.outputs[0].hist.data), 0)
+
+    def test_scratch(self):
+        code = code_oscillator_web.replace('calc(0.00001, 3)', 'calc(0.01, 3)')
+        for compiled in [True, False]:
+            for calc in ['', 'calc(0.01, 3, rk45)', 'record(0.1, 1)\ncalc(0.01, 3)']:
+                hists = []
+                with tempfile.TemporaryDirectory() as scratch:
+                    for sim in [Sim(compiled=compiled),
+                            Sim(compiled=compiled, scratch=scratch)]:
+                        parser = ExpressionEvaluator(sim=sim)
+                        with redirect_stdout(io.StringIO()):
+                            parser.parse(code + calc)
+                        hists.append([list(parser.sim.t_hist)] + [
+                                outp.hist.tolist() for block in sim.blocks
+                                for outp in block.outputs])
+                    # the files are deleted, the mappings have the values
+                    self.assertEqual(os.listdir(scratch), [])
+                hist = parser.memory['y'].outputs[0].hist
+                self.assertIsInstance(hist.data, memoryview)
+                self.assertFalse(hist.view().flags.owndata)
+                self.assertEqual(hists[0], hists[1])
+
+    def test_stream(self):
+        def run(compiled, code, stream):
+            sim, _ = build(code, compiled)
+            if stream:
+                chunks = list(sim.stream(*args))
+            else:
+                sim.calc(*args)
+            outputs = [outp for block in sim.blocks for outp in block.outputs]
+            if not stream:
+                return [list(sim.t_hist)] + [list(outp.hist)
+                        for outp in outputs]
+            self.assertTrue(all(len(t) <= CHUNK for t, _ in chunks))
+            self.assertEqual(len(sim.t_hist), 0)
+            return [np.concatenate([t for t, _ in chunks]).tolist()] + [
+                    np.concatenate([vals[outp] for _, vals in chunks]).tolist()
+                    for outp in outputs]
+
+        for compiled, code, args in [
+                (True, code_record, (0.001, 10)),
+                (False, code_record, (0.001, 10)),
+                (True, code_record, (0.001, 10, 'rk4')),
+                (True, code_record, (0.001, 20, None, 1e-6, 1e-9, 0.002, True)),
+                (True, code_wide, (0.001, 10))]:
+            streamed = run(compiled, code, True)
+            self.assertGreater(len(streamed[0]), CHUNK)
+            # the held nans are equal
+            self.assertTrue(all(np.array_equal(a, b, equal_nan=True)
+                    for a, b in zip(streamed, run(compiled, code, False))))
+
+    def test_cancel(self):
+        # the worker stops on the timeout, asyncio.run waits for it
+        start = time.time()
+        self.assertEqual(djex({}, 'while 1 < 2 {\n  x = 1\n}', timeout=0.2),
+                'Program was running for more than 0.2 sec and was terminated!\n')
+        self.assertLess(time.time() - start, 5)
+        # so do the loops of the fun blocks
+        for method in ['', ', rk4']:
+            start = time.time()
+            self.assertEqual(djex({}, code_fun_spin + f'calc(0.1, 1{method})',
+                    timeout=0.2), 'Program was running for more than ' +
+                    '0.2 sec and was terminated!\n')
+            self.assertLess(time.time() - start, 5)
+
+        for compiled, method, check in [(True, None, 100),
+                (False, None, 100), (True, 'rk4', 100), (True, 'rk45', 1)]:
+            cancel = threading.Event()
+            done = []
+
+            def progress(part):
+                done.append(part)
+                if part > 0.5:
+                    cancel.set()
+
+            sim = Sim(compiled=compiled, cancel=cancel, progress=progress,
+                    check_steps=check)
+            ExpressionEvaluator(sim=sim).parse(code_record)
+            with self.assertRaises(SimCancelled):
+                sim.calc(0.001, 10, method)
+            self.assertEqual(done, sorted(done))
+            self.assertTrue(0.5 < done[-1] < 1)
+
+        done = []
+        sim = Sim(progress=done.append, check_steps=100)
+        ExpressionEvaluator(sim=sim).parse(code_record + 'calc(0.001, 1)')
+        self.assertEqual([round(part, 5) for part in done],
+                [n/10 for n in range(10)] + [1.0])
+
+    def test_snapshot(self):
+        with tempfile.TemporaryDirectory() as scratch:
+            path = os.path.join(scratch, 'snap')
+            for compiled, method in [(True, None), (False, None),
+                    (True, 'rk4')]:
+                sim, memory = build(compiled=compiled)
+                sim.calc(0.01, 2, method)
+                whole = (list(sim.t_hist), list(memory['y'].outputs[0].hist))
+
+                sim, _ = build(compiled=compiled)
+                sim.calc(0.01, 1, method)
+                sim.save(path)
+                sim, memory = build(compiled=compiled)
+                y = memory['y'].outputs[0]
+                sim.load(path)
+                self.assertEqual(len(y.hist), len(sim.t_hist))
+                sim.calc(0.01, 2, method, resume=True)
+                self.assertEqual((list(sim.t_hist), list(y.hist)), whole)
+
+            # warm start with other pars
+            other = code_record.replace('1 - (', '2 - (')
+            for pars in [False, True]:
+                sim, memory = build(other)
+                sim.load(path, pars=pars)
+                sim.calc(0.01, 2, 'rk4', resume=True)
+                self.assertEqual(list(memory['y'].outputs[0].hist) ==
+                        whole[1], pars)
+
+            sim, _ = build('y = integ([], [0.0])')
+            with self.assertRaises(SimException):
+                sim.load(path)
+
+    def test_probes(self):
+        for compiled in [True, False]:
+            parser = ExpressionEvaluator(sim=Sim(compiled=compiled))
+            parser.parse(code_probe)
+            memory = parser.memory
+            self.assertEqual(len(memory['t'].outputs[0].hist), 100)
+            self.assertEqual(len(memory['y'].outputs[0].hist), 100)
+            self.assertEqual(len(memory['dy'].outputs[0].hist), 0)
+            self.assertAlmostEqual(memory['dy'].outputs[0].val, 0.66090, 5)
+            parser.parse('probe(dy)\ncalc(0.01, 1, rk4)')
+            self.assertEqual(len(memory['dy'].outputs[0].hist), 100)
+            self.assertEqual(len(memory['e'].outputs[0].hist), 0)
+
+    def test_plot(self):
+        # a constant is plotted on the steps of the run
+        with mock.patch.object(parser_utils, 'tpl', create=True) as tpl:
+            sim, memory = build(code_record + 'x = 1\ncalc(0.01, 1)\n' +
+                    'plot(t, x)\n')
+        (t, x), _ = tpl.figure().plot.call_args
+        self.assertEqual(list(t), list(sim.t_hist))
+        self.assertEqual(list(x), [1.0]*100)
+
+    def test_probes_unknown(self):
+        # the plotted signals are not known from the code,
+        #   so all the signals are recorded
+        for code in [
+                'def show(a, b) {\n  plot(a, b)\n}\ncalc(0.01, 1)\n',
+                'calc(0.01, 1)\nif 1 > 2 {\n  plot(t, e+0)\n}\n',
+                's = [t, e]\ncalc(0.01, 1)\nif 1 > 2 {\n' +
+                    '  plot(s[0], s[1])\n}\n',
+                'calc(0.01, 1)\nz = e\nif 1 > 2 {\n  plot(t, z)\n}\n']:
+            parser = ExpressionEvaluator()
+            parser.parse(code_record + code)
+            self.assertIsNone(parser.sim.probe_names)
+            self.assertEqual(len(parser.memory['e'].outputs[0].hist), 100)
+
+    def test_record(self):
+        def run(code, compiled=True):
+            sim, memory = build(code_record + code, compiled)
+            return list(sim.t_hist), memory['y'].outputs[0].hist
+
+        for compiled in [True, False]:
+            for method in ['', ', rk4']:
+                calc = f'calc(0.01, 1{method})'
+                t, y = run(calc, compiled)
+                self.assertEqual(run('record(0.1)\n' + calc, compiled),
+                        (t[::10], y[::10]))
+                buckets = np.array(y).reshape(10, 10)
+                envelope = np.stack([buckets.min(1), buckets.max(1)], 1)
+                self.assertEqual(run('record(0.1, 1)\n' + calc, compiled),
+                        (np.repeat(t[::10], 2).tolist(), envelope.ravel()))
+        # the adaptive steps are recorded once per interval,
+        #   0.01 and 0.06 are in the first one
+        t, _ = run('calc(0.01, 1, rk45)')
+        self.assertEqual(run('record(0.1)\ncalc(0.01, 1, rk45)')[0],
+                t[:1] + t[3:])
+        # a resumed run opens the envelope on its first step
+        for method in [None, 'rk45']:
+            sim, memory = build()
+            sim.calc(0.01, 1, method, every=0.05, envelope=True)
+            head = list(sim.t_hist)
+            sim.calc(0.01, 2, method, every=0.05, envelope=True, resume=True)
+            t, y = list(sim.t_hist), memory['y'].outputs[0].hist
+            self.assertEqual(t[:len(head)], head)
+            self.assertEqual(t[::2], t[1::2])
+            self.assertEqual(t, sorted(t))
+            self.assertLessEqual(y[-2], y[-1])
+            sim, memory = build()
+            sim.calc(0.01, 2, method, every=0.05, envelope=True)
+            self.assertAlmostEqual(y[-1], memory['y'].outputs[0].hist[-1], 5)
+
+    def test_steady(self):
+        def run(method=None, compiled=True, probes=()):
+            sim, memory = build(compiled=compiled)
+            sim.probe(*(memory[name] for name in probes))
+            sim.calc(0.01, 100, method, steady=1e-3, window=1)
+            return sim, memory['y'].outputs[0]
+
+        for method in [None, 'rk4', 'rk45']:
+            results = []
+            for compiled in [True, False]:
+                sim, y = run(method, compiled)
+                # the damped oscillator settles long before tmax
+                self.assertLess(sim.t_steady, 30)
+                self.assertGreaterEqual(sim.t_hist[-1], sim.t_steady + 1)
+                self.assertAlmostEqual(y.val, 1, 2)
+                results.append((sim.t_steady, list(sim.t_hist), y.hist))
+            self.assertEqual(results[0], results[1])
+        # the time does not depend on the states, the probed error does
+        sim, _ = run(probes=['y', 't'])
+        self.assertAlmostEqual(sim.t_steady, 27.66)
+        self.assertEqual(sim.n, 2867)
+
+        parser = ExpressionEvaluator()
+        f = io.StringIO()
+        with redirect_stdout(f):
+            # the plot against the time probes it
+            parser.parse(code_record + 'steady(0.001, 1)\ncalc(0.01, 100)\n' +
+                    'stats()\nsteady(0)\ncalc(0.01, 100)\nstats()\n' +
+                    'if 1 > 2 {\n  plot(t, y)\n}\n')
+        self.assertEqual(f.getvalue(),
+                'accepted: 2867, rejected: 0, evals: 2867, events: 0\n' +
+                'steady: 27.66\n' +
+                'accepted: 10000, rejected: 0, evals: 10000, events: 0\n')
+
+    def test_batches(self):
+        results = []
+        for compiled in [True, False]:
+            parser = ExpressionEvaluator(sim=Sim(compiled=compiled))
+            f = io.StringIO()
+            with redirect_stdout(f):
+                parser.parse(code_wide)
+            results.append((f.getvalue(), [outp.hist for block in
+                    parser.sim.blocks for outp in block.outputs]))
+        self.assertTrue(use_batches(parser.sim.schedule()))
+        self.assertEqual(results[0], results[1])
+
+    def test_rk4(self):
+        self.assertEqual(float(djex({}, code_oscillator_rk4)), 1.61094)
+
+    def test_symplectic(self):
+        # rect_meth in the schedule order is the symplectic Euler here
+        self.assertEqual(djex({}, code_oscillator_symplectic),
+                djex({}, code_oscillator_euler))
+
+    def test_rk45(self):
+        parser = ExpressionEvaluator()
+        f = io.StringIO()
+        with redirect_stdout(f):
+            parser.parse(code_oscillator_rk45)
+        self.assertEqual(f.getvalue(),
+                'accepted: 17, rejected: 0, evals: 103, events: 0\n1.61094\n')
+        t_hist = parser.sim.t_hist
+        self.assertEqual((len(t_hist), t_hist[-1]), (18, 3))
+        self.assertEqual(len(parser.memory['y'].outputs[0].hist), 18)
+
+    def test_exact(self):
+        w = 2.0
+        self.assertTrue(np.allclose(expm(np.array([[0, -w], [w, 0]])),
+                [[np.cos(w), -np.sin(w)], [np.sin(w), np.cos(w)]],
+                rtol=0, atol=1e-15))
+        # any step is exact for a linear diagram
+        self.assertEqual(djex({}, code_oscillator_web.replace(
+                'calc(0.00001, 3)', 'calc(0.5, 3, exact)\nstats()')),
+                'accepted: 6, rejected: 0, evals: 0, events: 0\n1.61094\n')
+        parser = ExpressionEvaluator()
+        with redirect_stdout(io.StringIO()):
+            parser.parse(code_harmonic_web.replace('calc(0.001, 10)',
+                    'calc(2, 10, exact)'))
+        self.assertAlmostEqual(parser.memory['y'].outputs[0].val,
+                1 - np.exp(-10), 12)
+
+        def run(method='exact', **kw):
+            sim, memory = build()
+            sim.calc(0.01, 10, method, **kw)
+            return list(sim.t_hist), memory['y'].outputs[0].hist
+
+        t, y = run()
+        self.assertEqual(run(every=0.1), (t[::10], y[::10]))
+        # the times are the same as for the solvers
+        t_rk4, y_rk4 = run('rk4')
+        self.assertEqual(t_rk4, t)
+        self.assertTrue(np.allclose(y_rk4, y, rtol=0, atol=1e-9))
+
+        self.assertEqual(djex({}, 'y = integ([], [1.0])\nz = y*y\n' +
+                'z @ y\ncalc(0.1, 1, exact)'),
+                'exact method needs linear blocks, not mult0\n')
+
+    def test_jacobian(self):
+        parser = ExpressionEvaluator()
+        parser.parse(code_oscillator_web.split('calc')[0])
+        system = System(parser.sim.schedule(stages=True))
+        [(idx, jac)] = system.jacobian(0, system.x0)
+        self.assertEqual(idx.tolist(), [0, 1])
+        self.assertEqual(jac.tolist(), [[-0.3, -1], [1, 0]])
+
+    def test_ros2(self):
+        parser = ExpressionEvaluator()
+        f = io.StringIO()
+        with redirect_stdout(f):
+            parser.parse(code_stiff)
+        self.assertEqual(f.getvalue(), '1.0\n')
+        self.assertLess(parser.sim.stats.accepted, 1000)
+
+        # the default tolerances are the ones of the method
+        code = 'a = integ([], [0.0])\nv = a @ integ([], [0.0])\n' + \
+                '1 @ a\ncalc(0.01, 0.3, ros2{})\nprint(v)\n'
+        for tols, steps in [('', 200), (', 0.000001, 0.000000001', 5000)]:
+            parser = ExpressionEvaluator()
+            with redirect_stdout(io.StringIO()) as f:
+                parser.parse(code.format(tols))
+            self.assertEqual(f.getvalue(), '0.045\n')
+            self.assertEqual(parser.sim.stats.accepted > 1000, steps > 1000)
+            self.assertLess(parser.sim.stats.accepted, steps)
+
+    def test_event(self):
+        self.assertEqual(djex({}, code_event),
+                'accepted: 4, rejected: 0, evals: 35, events: 1\n1.3\n')
+        parser = ExpressionEvaluator()
+        with redirect_stdout(io.StringIO()):
+            parser.parse(code_event.replace(', rk4', ', rk45'))
+        self.assertEqual(parser.sim.stats.events, 1)
+        self.assertAlmostEqual(parser.memory['y'].outputs[0].hist[-1], 1.3)
+        self.assertIn(0.5, [round(t, 9) for t in parser.sim.t_hist])
+
+        # the states slide on e = 0 from t2 on (both sides of the sign
+        #   push towards it), where y = 1 - (1 - y2)*exp(-(t - t2)/0.8),
+        #   the events keep the solution exact, without them the steps
+        #   chatter around the surface
+        t1 = (np.sqrt(10.56) - 1.6)/2
+        t2, tau = 3*t1 - 1.6, 2*(t1 - 0.8)
+        y2 = t1**2/2 + t1*tau - tau**2/2
+        def error(method, crossings):
+            code = code_slide_web.replace('fun([sign, 1]',
+                    f'fun([sign, 1{crossings}]').replace('calc(0.00005, 2)',
+                    f'calc(0.01, 2, {method})')
+            with redirect_stdout(io.StringIO()):
+                sim, memory = build(code)
+            exact = 1 - (1 - y2)*np.exp(-(sim.t - t2)/0.8)
+            return abs(memory['y'].outputs[0].val - exact)
+
+        for method, tol in [('rk4', 1e-8), ('heun', 1e-5), ('rk45', 1e-6),
+                ('ros2', 1e-3)]:
+            self.assertLess(error(method, ', 1'), tol)
+            if method != 'rk45':
+                self.assertLess(error(method, ', 1'), error(method, '')/2)
+
+    def test_discrete(self):
+        self.assertEqual(djex({}, code_discrete),
+                '0.0\n1.0\n1.5\n2.0\n2.5\n7.75\n')
+        for compiled in [True, False]:
+            parser = ExpressionEvaluator(sim=Sim(compiled=compiled))
+            with redirect_stdout(io.StringIO()):
+                parser.parse(code_discrete)
+            self.assertEqual(parser.memory['d'].outputs[0].hist[-9:],
+                    [0, 0, 1, 1, 1.5, 1.5, 2, 2, 2.5])
+            self.assertEqual(parser.memory['c'].outputs[0].hist[-9:],
+                    [0, 0, 0.5, 0.5, 1, 1, 1.5, 1.5, 2])
+        self.assertEqual(djex({}, code_discrete.replace(
+                'calc(0.25, 2)', 'calc(0.25, 2, rk4)')).split('\n')[-2],
+                'discrete blocks need the default method, not rk4')
+
+    def test_algebraic_loop(self):
+        self.assertEqual(djex({}, code_algebraic_loop), '-1.0 -2.0\n')
+        for compiled in [True, False]:
+            parser = ExpressionEvaluator(sim=Sim(compiled=compiled))
+            with redirect_stdout(io.StringIO()):
+                parser.parse(code_algebraic_loop.replace(
+                        'calc(0.1, 1)', 'calc(0.1, 1, rk4)'))
+            self.assertEqual(parser.memory['a'].outputs[0].hist[-1], -1)
+        # only the loops which are solved take ids
+        sim, _ = build(code_algebraic_loop.split('calc')[0] +
+                'b = add([], [])\na.out[0] @ b.in[0]\n' +
+                'h = b @ num([2], [])\nh.out[0] @ b.in[1]\n')
+        self.assertEqual([block.id for block in sim.schedule()
+                if block.block_type == 'loop'], [0, 1])
+
+    def test_bad_loop(self):
+        self.assertEqual(djex({}, code_bad_loop),
+                'algebraic loop Loop(blocks=[\'add0\']) did not converge\n')
+
+    def test_unconnected(self):
+        self.assertEqual(djex({}, code_unconnected),
+                'blocks with unconnected inputs: add0\n')
+
     def test_array_fun(self):
         self.assertEqual(float(djex({}, code_array_fun)), 33)
 
@@ -523,6 +1212,15 @@ class TestParser(unittest.TestCase):
     def test_signal_routing_web(self):
         self.assertEqual(djex({}, code_signal_routing_web), '7.0\n21.0\n')
 
+    def test_example_diagram(self):
+        # the disp block shows the integ of the same step, before the
+        #   schedule it ran in the list order after the first step and
+        #   lagged one step behind (2.98344)
+        out = subprocess.run([sys.executable, 'diagram_parser.py'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                capture_output=True, text=True, check=True).stdout
+        self.assertEqual(out.split('\n')[-3], '2.98361')
+
     def test_slide_web(self):
         self.assertAlmostEqual(float(djex({}, code_slide_web)), 0.84814)
 